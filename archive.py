@@ -0,0 +1,210 @@
+import os
+import re
+import sys
+import json
+import glob
+import sqlite3
+import datetime
+from typing import List
+
+from tree import MessageNode, flatten_node, conversation_root
+
+class ConversationArchive:
+    # SQLite store for saved conversations. Nodes are rows indexed by conversation and parent, so listing
+    # conversations reads no messages and opening one only loads the selected path and the branches next to it.
+    # The other branches are loaded through MessageNode.loader when they are selected.
+
+    def __init__(self, db_file: str = 'completions/archive.db'):
+        self.db_file = db_file
+        directory = os.path.dirname(db_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(db_file)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                model TEXT,
+                total_tokens INTEGER,
+                saved TEXT,
+                source TEXT
+            );
+            CREATE TABLE IF NOT EXISTS nodes (
+                conversation_id INTEGER NOT NULL,
+                id TEXT NOT NULL,
+                parent_id TEXT,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                message TEXT NOT NULL,
+                selected_child_id TEXT,
+                info TEXT,
+                PRIMARY KEY (conversation_id, id)
+            );
+            CREATE INDEX IF NOT EXISTS nodes_by_parent ON nodes (conversation_id, parent_id, position);
+            CREATE INDEX IF NOT EXISTS conversations_by_source ON conversations (source);
+        ''')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(nodes)')]
+        if 'info' not in columns:
+            # Archives from before responses were tagged with their model
+            self.db.execute('ALTER TABLE nodes ADD COLUMN info TEXT')
+        self.fts = self.create_index()
+
+    def create_index(self) -> bool:
+        # Full-text index over every message of every branch, kept up to date by triggers. Needs SQLite with FTS5,
+        # without it search falls back to a slow scan.
+        exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_fts'").fetchone() is not None
+        try:
+            with self.db:
+                self.db.executescript('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts5(message, content='nodes', content_rowid='rowid');
+                    CREATE TRIGGER IF NOT EXISTS nodes_fts_insert AFTER INSERT ON nodes BEGIN
+                        INSERT INTO nodes_fts (rowid, message) VALUES (new.rowid, new.message);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS nodes_fts_delete AFTER DELETE ON nodes BEGIN
+                        INSERT INTO nodes_fts (nodes_fts, rowid, message) VALUES ('delete', old.rowid, old.message);
+                    END;
+                ''')
+                if not exists:
+                    # Index the messages of an archive created before the index existed
+                    self.db.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print(f'Full-text search is not available, searching will be slow\n{e}')
+            return False
+        return True
+
+    def save(self, name: str, root: MessageNode, model: str, total_tokens: int, source: str = None) -> int:
+        saved = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.db:
+            cursor = self.db.execute('INSERT INTO conversations (name, model, total_tokens, saved, source) VALUES (?, ?, ?, ?, ?)',
+                                     (name, model, total_tokens, saved, source))
+            conversation_id = cursor.lastrowid
+            positions = {}
+            rows = []
+            for row in flatten_node(root):
+                position = positions.get(row['parent_id'], 0)
+                positions[row['parent_id']] = position + 1
+                info = json.dumps(row['info']) if row['info'] is not None else None
+                rows.append((conversation_id, row['id'], row['parent_id'], position, row['role'], row['message'], row['selected_child_id'], info))
+            self.db.executemany('''INSERT INTO nodes (conversation_id, id, parent_id, position, role, message, selected_child_id, info)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        return conversation_id
+
+    def list(self):
+        return self.db.execute('SELECT id, name, model, total_tokens, saved FROM conversations ORDER BY saved DESC, id DESC').fetchall()
+
+    def delete(self, conversation_id: int):
+        with self.db:
+            self.db.execute('DELETE FROM nodes WHERE conversation_id = ?', (conversation_id,))
+            self.db.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+
+    def load(self, conversation_id: int):
+        # Returns the conversation's info and its root node, only the selected branch below the root is loaded
+        info = self.db.execute('SELECT id, name, model, total_tokens, saved FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+        if info is None:
+            raise Exception(f'No conversation {conversation_id} in {self.db_file}')
+        row = self.db.execute('SELECT id, role, message FROM nodes WHERE conversation_id = ? AND parent_id IS NULL', (conversation_id,)).fetchone()
+        root = MessageNode(row[2], row[1], id=row[0])
+        root.loader = self.make_loader(conversation_id)
+        return {
+            'id': info[0],
+            'name': info[1],
+            'model': info[2],
+            'total_tokens': info[3],
+            'saved': info[4],
+        }, root
+
+    def make_loader(self, conversation_id: int):
+        # One loader is shared by every unloaded node of a conversation
+        def load_children(node: MessageNode):
+            selected = self.db.execute('SELECT selected_child_id FROM nodes WHERE conversation_id = ? AND id = ?',
+                                       (conversation_id, node.id)).fetchone()
+            rows = self.db.execute('SELECT id, role, message, info FROM nodes WHERE conversation_id = ? AND parent_id = ? ORDER BY position',
+                                   (conversation_id, node.id)).fetchall()
+            selected_node = None
+            for id, role, message, info in rows:
+                child = MessageNode(message, role, id=id, info=json.loads(info) if info else None)
+                child.loader = load_children
+                node.add_child(child)
+                if selected is not None and id == selected[0]:
+                    selected_node = child
+            if selected_node is not None:
+                node.selected_child = selected_node
+        return load_children
+
+    def import_file(self, file_name: str) -> int:
+        # Import a conversation saved as JSON in completions/, replacing an earlier import of the same file
+        with open(file_name, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        root = conversation_root(data)
+        if root is None:
+            raise Exception(f'No conversation in {file_name}')
+        name = os.path.splitext(os.path.basename(file_name))[0]
+        for (conversation_id,) in self.db.execute('SELECT id FROM conversations WHERE source = ?', (file_name,)).fetchall():
+            self.delete(conversation_id)
+        return self.save(name, root, data.get('model'), data.get('total_tokens', 0), source=file_name)
+
+    def import_directory(self, directory: str = 'completions') -> List[str]:
+        # Import every JSON file that is not in the archive yet, returns the files that were imported
+        imported = set(row[0] for row in self.db.execute('SELECT source FROM conversations WHERE source IS NOT NULL'))
+        files = []
+        for file_name in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            if file_name in imported:
+                continue
+            try:
+                self.import_file(file_name)
+                files.append(file_name)
+            except Exception as e:
+                print(f'Could not import {file_name}\n{e}')
+        return files
+
+    def search(self, query: str, limit: int = 50):
+        # Messages matching every term and "quoted phrase" in query, best matches first.
+        # Returns (conversation_id, name, source, node_id, role, snippet) for each.
+        terms = re.findall(r'"[^"]*"|[^\s"]+', query)
+        if not terms:
+            return []
+        if not self.fts:
+            return self.scan(terms, limit)
+        # Quote every term so that characters with a meaning in the FTS5 query syntax are searched for as they are
+        match = ' '.join('"' + term.strip('"').replace('"', '""') + '"' for term in terms)
+        return self.db.execute('''
+            SELECT n.conversation_id, c.name, c.source, n.id, n.role, snippet(nodes_fts, 0, '[', ']', '...', 12)
+            FROM nodes_fts
+            JOIN nodes n ON n.rowid = nodes_fts.rowid
+            JOIN conversations c ON c.id = n.conversation_id
+            WHERE nodes_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ''', (match, limit)).fetchall()
+
+    def scan(self, terms: List[str], limit: int):
+        conditions = ' AND '.join('n.message LIKE ?' for _ in terms)
+        rows = self.db.execute(f'''
+            SELECT n.conversation_id, c.name, c.source, n.id, n.role, substr(n.message, 1, 80)
+            FROM nodes n JOIN conversations c ON c.id = n.conversation_id
+            WHERE {conditions}
+            LIMIT ?
+        ''', [f'%{term.strip(chr(34))}%' for term in terms] + [limit]).fetchall()
+        return rows
+
+    def get_path_ids(self, conversation_id: int, node_id: str) -> List[str]:
+        # Ids of the nodes from the root down to node_id
+        ids = []
+        while node_id is not None:
+            ids.append(node_id)
+            row = self.db.execute('SELECT parent_id FROM nodes WHERE conversation_id = ? AND id = ?', (conversation_id, node_id)).fetchone()
+            if row is None:
+                raise Exception(f'No message {node_id} in conversation {conversation_id}')
+            node_id = row[0]
+        ids.reverse()
+        return ids
+
+    def close(self):
+        self.db.close()
+
+if __name__ == '__main__':
+    # python archive.py [directory] imports the JSON conversations in directory (default completions/)
+    archive = ConversationArchive()
+    imported = archive.import_directory(sys.argv[1] if len(sys.argv) > 1 else 'completions')
+    print(f'Imported {len(imported)} conversations into {archive.db_file}')
+    archive.close()
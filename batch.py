@@ -0,0 +1,167 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from typing import List
+
+from key import get_key
+from gpt import GptChat
+from tree import ConversationTree, conversation_data
+from scheduler import Request, RequestScheduler
+from cache import CompletionCache
+from metrics import metrics, JsonlSink
+
+# Runs prompts through the model without the UI. Every line of the input is a JSON object with an "id" and either
+# a "prompt" or a list of user "turns" that are sent one after the other, each seeing the previous responses.
+#
+#   python batch.py prompts.jsonl results.jsonl --concurrency 16 --trees trees/
+
+def read_jobs(file_name: str) -> List[dict]:
+    jobs = []
+    with open(file_name, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            if 'turns' not in job:
+                if 'prompt' not in job:
+                    raise Exception(f'Line {line_number} of {file_name} has neither "prompt" nor "turns"')
+                job['turns'] = [job['prompt']]
+            job.setdefault('id', str(line_number))
+            job['line'] = line_number
+            jobs.append(job)
+    return jobs
+
+def tree_file_name(job: dict) -> str:
+    # Ids come from the input, one that is not a plain file name is replaced by the line number
+    name = str(job['id'])
+    if not re.fullmatch(r'[\w.-]+', name) or not name.strip('.'):
+        name = f"line_{job['line']}"
+    return f'{name}.json'
+
+def run_job(client: GptChat, job: dict, request: Request, max_tokens: int, use_cache: bool):
+    # Runs on a worker thread, the tree belongs to this job only
+    tree = ConversationTree(client.system_prompt)
+    usage = { 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0 }
+    responses = []
+    # The request covers every turn: the first token is the one of the first turn, the retries are added up and it
+    # only counts as a cache hit if every turn was
+    stats = { 'retries': 0, 'cache_hit': True }
+    for turn in job['turns']:
+        node = tree.add_message(turn, 'user')
+        turn_usage = {}
+        turn_stats = {}
+        response = client.complete(tree.get_context(node), max_tokens, cancel=request.cancel_event,
+                                   prompt_tokens=tree.get_prompt_tokens(node), usage=turn_usage, use_cache=use_cache, stats=turn_stats)
+        tree.add_response(node, response)
+        responses.append(response)
+        for name in usage:
+            usage[name] += turn_usage.get(name, 0)
+        stats.setdefault('first_token', turn_stats.get('first_token'))
+        stats['retries'] += turn_stats.get('retries', 0)
+        stats['cache_hit'] = stats['cache_hit'] and turn_stats.get('cache_hit', False)
+    request.usage.update(usage)
+    request.stats.update(stats)
+    return tree, responses, usage
+
+class BatchRunner:
+    def __init__(self, client: GptChat, concurrency: int = 8, max_tokens: int = 1000, use_cache: bool = True):
+        self.client = client
+        self.scheduler = RequestScheduler(max_workers=concurrency)
+        self.max_tokens = max_tokens
+        self.use_cache = use_cache
+        self.done = 0
+        self.errors = 0
+        self.total = 0
+        self.started = None
+        self.last_report = 0
+
+    def run(self, jobs: List[dict], results_file: str, trees_dir: str = None):
+        if trees_dir is not None and not os.path.exists(trees_dir):
+            os.makedirs(trees_dir)
+        self.total = len(jobs)
+        self.started = time.time()
+        with open(results_file, 'w', encoding='utf-8') as out:
+            def on_done(job, result):
+                tree, responses, usage = result
+                self.write_result(out, { 'id': job['id'], 'responses': responses, 'usage': usage })
+                if trees_dir is not None:
+                    self.write_tree(tree, os.path.join(trees_dir, tree_file_name(job)), usage)
+            def on_error(job, e):
+                self.errors += 1
+                self.write_result(out, { 'id': job['id'], 'error': str(e) })
+
+            for job in jobs:
+                self.scheduler.submit(
+                    lambda request, job=job: run_job(self.client, job, request, self.max_tokens, self.use_cache),
+                    label=str(job['id']),
+                    on_done=lambda result, job=job: on_done(job, result),
+                    on_error=lambda e, job=job: on_error(job, e),
+                    on_cancel=lambda job=job: on_error(job, 'cancelled')
+                )
+            try:
+                # Results are written from this thread only, the workers just hand them over
+                while self.done < self.total:
+                    self.scheduler.process_callbacks()
+                    time.sleep(0.05)
+            except KeyboardInterrupt:
+                print('\nCancelling the remaining prompts', file=sys.stderr)
+                self.scheduler.cancel_all()
+                while self.scheduler.active() or not self.scheduler.callbacks.empty():
+                    self.scheduler.process_callbacks()
+                    time.sleep(0.05)
+        print(file=sys.stderr)
+
+    def write_result(self, out, result: dict):
+        out.write(json.dumps(result, ensure_ascii=False) + '\n')
+        out.flush()
+        self.done += 1
+        self.report()
+
+    def write_tree(self, tree: ConversationTree, file_name: str, usage: dict):
+        # Same format as the files saved from the app, so they can be loaded or imported into the archive
+        with open(file_name, 'w', encoding='utf-8') as f:
+            json.dump(conversation_data(tree.root, self.client.model, usage['total_tokens']), f, indent=4)
+
+    def report(self):
+        # At most a couple of updates a second, and always the last one
+        now = time.time()
+        if now - self.last_report < 0.5 and self.done < self.total:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0
+        print(f'\r{self.done}/{self.total} done, {self.errors} failed, {rate:.2f} prompts/s', end='', file=sys.stderr, flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run prompts from a JSONL file through the model')
+    parser.add_argument('input', help='JSONL file with an "id" and a "prompt" or a list of "turns" per line')
+    parser.add_argument('output', help='JSONL file the responses are written to')
+    parser.add_argument('--trees', help='folder to write every conversation to in the saved conversation format')
+    parser.add_argument('--model', default='gpt-4o')
+    parser.add_argument('--system-prompt', default='sys_prompt.txt')
+    parser.add_argument('--base-url', help='OpenAI compatible server to send the prompts to instead of the OpenAI API')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of requests in flight at once')
+    parser.add_argument('--max-tokens', type=int, default=1000)
+    parser.add_argument('--no-cache', action='store_true', help='always ask the model instead of using cached responses')
+    parser.add_argument('--metrics', help='JSONL file to append the metrics of every request to')
+    args = parser.parse_args()
+
+    jobs = read_jobs(args.input)
+    if args.metrics:
+        metrics.add_sink(JsonlSink(args.metrics))
+    client = GptChat(args.system_prompt, get_key(), args.base_url)
+    client.change_model(args.model)
+    client.verbose = False  # The progress line is the output
+    if not args.no_cache:
+        client.cache = CompletionCache()
+    runner = BatchRunner(client, args.concurrency, args.max_tokens, not args.no_cache)
+    runner.run(jobs, args.output, args.trees)
+    if client.cache is not None:
+        print(f'Cache: {client.cache.stats()}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+import tokens
+from tree import ConversationTree, serialize_node, deserialize_node, flatten_node, unflatten_nodes, load_branch
+from archive import ConversationArchive
+
+# Times the hot paths of the tree, the save formats and the message list on synthetic conversations. Needs no API
+# key or network. Results are written as JSON and can be compared against an earlier run:
+#
+#   python bench.py --output baseline.json
+#   python bench.py --baseline baseline.json
+
+NOISE_MS = 0.005  # Differences below this are timer noise and never count as slower or faster
+
+def make_tree(depth: int, branching: int, message_size: int, doc_size: int, doc_every: int, seed: int = 0):
+    # A conversation of depth user/assistant turns. Every user message has branching responses, the first of which is
+    # continued (add_response keeps it selected), and every doc_every-th user message is a document of doc_size characters.
+    rng = random.Random(seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'tree', 'branch', 'token', 'model', 'chat']
+    def text(size):
+        parts = []
+        length = 0
+        while length < size:
+            word = rng.choice(words)
+            parts.append(word)
+            length += len(word) + 1
+        return ' '.join(parts)[:size]
+    tree = ConversationTree('You are a helpful assistant.')
+    for turn in range(depth):
+        size = doc_size if doc_every and turn % doc_every == doc_every - 1 else message_size
+        user_node = tree.add_message(text(size), 'user')
+        for _ in range(branching):
+            tree.add_response(user_node, text(message_size))
+        tree.current_node = user_node.selected_child
+    return tree
+
+def time_it(fn, repeat: int, setup=None, number: int = 1):
+    # fn gets whatever setup returns, setup is not timed. Fast calls are run number times per repeat and averaged.
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(arg)
+        times.append((time.perf_counter() - start) * 1000 / number)
+    return { 'min_ms': round(min(times), 4), 'median_ms': round(statistics.median(times), 4), 'repeat': repeat }
+
+def clear_caches(tree: ConversationTree):
+    tree.contexts = {}
+    tree.prompt_tokens = {}
+    return tree
+
+def bench_tree(tree: ConversationTree, repeat: int):
+    results = {}
+    leaf = tree.current_node
+    results['path_from_root'] = time_it(lambda _: tree.get_path_from_root(leaf), repeat, number=1000)
+    results['context_cold'] = time_it(lambda t: t.get_context(leaf), repeat, lambda: clear_caches(tree))
+    results['context_warm'] = time_it(lambda _: tree.get_context(leaf), repeat, number=1000)
+
+    def count_cold(t):
+        t.get_prompt_tokens(leaf)
+    def reset_counts():
+        clear_caches(tree)
+        for node in tree.get_path_from_root(leaf):
+            node.token_count = None
+        return tree
+    results['prompt_tokens_cold'] = time_it(count_cold, repeat, reset_counts)
+    results['prompt_tokens_warm'] = time_it(lambda _: tree.get_prompt_tokens(leaf), repeat, number=1000)
+
+    # Switch sampled user messages on the path to their last response and back to the one that is continued,
+    # building the context each time. The path is left as it was, the format benchmarks save and load it.
+    user_nodes = [node for node in tree.get_path_from_root(leaf) if node.role == 'user' and len(node.children) > 1]
+    sampled = [(node, node.selected_index) for node in user_nodes[::max(1, len(user_nodes) // 20)]]
+    def switch(_):
+        for node, selected_index in sampled:
+            tree.select_branch(node, len(node.children) - 1)
+            tree.get_context()
+            tree.select_branch(node, selected_index)
+            tree.get_context()
+    results['branch_switch'] = time_it(switch, repeat, number=100)
+    for node, selected_index in sampled:
+        node.selected_index = selected_index
+    tree.current_node = leaf
+    return results
+
+def bench_formats(tree: ConversationTree, repeat: int, directory: str):
+    results = {}
+    root = tree.root
+    results['serialize_nested'] = time_it(lambda _: json.dumps(serialize_node(root), indent=4), repeat)
+    nested = json.dumps(serialize_node(root), indent=4)
+    results['deserialize_nested'] = time_it(lambda _: deserialize_node(json.loads(nested)), repeat)
+    results['serialize_flat'] = time_it(lambda _: json.dumps(flatten_node(root)), repeat)
+    flat = json.dumps(flatten_node(root))
+    results['deserialize_flat'] = time_it(lambda _: unflatten_nodes(json.loads(flat)), repeat)
+    results['nested_bytes'] = len(nested.encode('utf-8'))
+    results['flat_bytes'] = len(flat.encode('utf-8'))
+
+    archive = ConversationArchive(os.path.join(directory, 'archive.db'))
+    saved = []
+    results['archive_save'] = time_it(lambda _: saved.append(archive.save('bench', root, 'bench', 0)), repeat)
+    def load(_):
+        _, loaded = archive.load(saved[-1])
+        load_branch(loaded)
+    results['archive_load'] = time_it(load, repeat)
+    archive.close()
+    return results
+
+class StubCanvas:
+    # Stands in for the canvas when there is no display, only the layout arithmetic of ChatView is timed then
+    def configure(self, **kw): pass
+    def after_idle(self, fn): pass
+    def winfo_width(self): return 800
+    def winfo_height(self): return 600
+    def canvasy(self, y): return y
+
+def make_stub_view():
+    from chat_view import ChatView
+    view = ChatView.__new__(ChatView)
+    view.on_edit = view.on_select_branch = view.format_message = None
+    view.canvas = StubCanvas()
+    view.line_height = 15
+    view.items = []
+    view.offsets = []
+    view.positions = {}
+    view.slots = []
+    view.total_height = 0
+    view.follow_bottom = True
+    view.render_scheduled = False
+    return view
+
+def bench_view(tree: ConversationTree, repeat: int, headless: bool):
+    # With a display (e.g. under xvfb-run) the real widgets are created and drawn, otherwise a stub canvas is used
+    path = tree.get_path_from_root()[1:]
+    root = None
+    if not headless:
+        try:
+            import tkinter as tk
+            root = tk.Tk()
+            root.geometry('1280x720')
+        except Exception:
+            root = None
+    if root is None:
+        results = { 'view_extend_stub': time_it(lambda view: view.extend(path), repeat, make_stub_view) }
+        def append_all(view):
+            for node in path:
+                view.append(node)
+        results['view_append_stub'] = time_it(append_all, repeat, make_stub_view)
+        return results, 'stub'
+
+    import tkinter as tk
+    from chat_view import ChatView
+    frame = tk.Frame(root)
+    frame.pack(expand=True, fill='both')
+    view = ChatView(frame, lambda node: None, lambda node, label: None)
+    def setup():
+        view.clear()
+        root.update()
+        return view
+    def extend(view):
+        view.extend(path)
+        root.update()
+    results = { 'view_extend': time_it(extend, repeat, setup) }
+    def scroll(view):
+        for fraction in (0, 0.25, 0.5, 0.75, 1):
+            view.yview('moveto', fraction)
+            root.update()
+    results['view_scroll'] = time_it(scroll, repeat, lambda: view)
+    root.destroy()
+    return results, 'tk'
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    # Prints every timing next to the baseline, returns False if any is more than threshold times slower
+    ok = True
+    print(f"{'benchmark':<32}{'baseline ms':>14}{'current ms':>14}{'ratio':>8}")
+    for name, result in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not isinstance(result, dict) or not isinstance(old, dict):
+            continue
+        ratio = result['min_ms'] / old['min_ms'] if old['min_ms'] > 0 else 1
+        flag = ''
+        if abs(result['min_ms'] - old['min_ms']) < NOISE_MS:
+            pass
+        elif ratio > threshold:
+            flag = '  slower'
+            ok = False
+        elif ratio < 1 / threshold:
+            flag = '  faster'
+        print(f"{name:<32}{old['min_ms']:>14.3f}{result['min_ms']:>14.3f}{ratio:>8.2f}{flag}")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the conversation tree, save formats and message list')
+    parser.add_argument('--depth', type=int, default=200, help='number of user/assistant turns')
+    parser.add_argument('--branching', type=int, default=3, help='responses per user message')
+    parser.add_argument('--message-size', type=int, default=500, help='characters per message')
+    parser.add_argument('--doc-size', type=int, default=100000, help='characters per document message')
+    parser.add_argument('--doc-every', type=int, default=25, help='every n-th user message is a document, 0 for none')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--headless', action='store_true', help='time the message list on a stub canvas even if a display is available')
+    parser.add_argument('--estimate-tokens', action='store_true', help='count tokens without tiktoken')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio to the baseline that counts as slower')
+    args = parser.parse_args()
+
+    if args.estimate_tokens:
+        tokens._encoding = False
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))  # json.dumps of the nested format recurses per level
+
+    tree = make_tree(args.depth, args.branching, args.message_size, args.doc_size, args.doc_every)
+    directory = tempfile.mkdtemp(prefix='simple_llm_bench_')
+    try:
+        results = {}
+        results.update(bench_tree(tree, args.repeat))
+        results.update(bench_formats(tree, args.repeat, directory))
+        view_results, view_mode = bench_view(tree, args.repeat, args.headless)
+        results.update(view_results)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'tiktoken': bool(tokens.get_encoding()),
+            'view': view_mode,
+            'params': { name: getattr(args, name) for name in ('depth', 'branching', 'message_size', 'doc_size', 'doc_every', 'repeat') },
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('params') != output['meta']['params']:
+            print('Warning: the baseline was run with different parameters')
+        if not compare(output, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List
+
+from retrieval import ChunkIndex, TOP_K
+
+# Included documents are stored once under their sha256 digest, messages only hold a reference to them. A document
+# reference is replaced by the whole text, an excerpts reference only by the chunks relevant to the latest message.
+REFERENCE_PATTERN = re.compile(r'<<(document|excerpts) ([0-9a-f]{64})(?: ([^>]*))?>>')
+PREVIEW_CHARS = 200
+CHUNK_SIZE = 1024 * 1024
+
+def make_reference(digest: str, name: str = '', kind: str = 'document') -> str:
+    name = name.replace('>', '')
+    return f'<<{kind} {digest} {name}>>' if name else f'<<{kind} {digest}>>'
+
+def has_references(text: str) -> bool:
+    return '<<' in text and REFERENCE_PATTERN.search(text) is not None
+
+class BlobStore:
+    def __init__(self, directory: str = 'blobs', max_cached_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.max_cached_bytes = max_cached_bytes
+        self.lock = threading.Lock()  # Payloads are expanded on the worker threads
+        self.texts = OrderedDict()  # Recently expanded documents by digest, least recently used first
+        self.cached_bytes = 0
+        self.previews = {}
+        self.indexes = {}  # Chunk indexes of the documents included as excerpts, by digest
+        self.top_k = TOP_K  # Number of chunks an excerpts reference is replaced by
+
+    def get_file(self, digest: str) -> str:
+        # Two levels so a large store does not end up as one huge folder
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, text: str) -> str:
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        file_name = self.get_file(digest)
+        if not os.path.exists(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(file_name + '.tmp', file_name)
+        return digest
+
+    def put_file(self, path: str) -> str:
+        # Hashes and copies the file in chunks, so including a document never holds it in memory
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_name = os.path.join(self.directory, f'incoming_{threading.get_ident()}.tmp')
+        sha = hashlib.sha256()
+        with open(path, 'r', encoding='utf-8') as src, open(tmp_name, 'wb') as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data = chunk.encode('utf-8')
+                sha.update(data)
+                dst.write(data)
+        digest = sha.hexdigest()
+        file_name = self.get_file(digest)
+        if os.path.exists(file_name):
+            os.remove(tmp_name)
+        else:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            os.replace(tmp_name, file_name)
+        return digest
+
+    def get(self, digest: str) -> str:
+        with self.lock:
+            if digest in self.texts:
+                self.texts.move_to_end(digest)
+                return self.texts[digest]
+        file_name = self.get_file(digest)
+        if not os.path.exists(file_name):
+            raise Exception(f"Could not find document {digest} in {self.directory}")
+        with open(file_name, 'r', encoding='utf-8') as f:
+            text = f.read()
+        with self.lock:
+            if digest not in self.texts:
+                self.texts[digest] = text
+                self.cached_bytes += len(text)
+                while self.cached_bytes > self.max_cached_bytes and len(self.texts) > 1:
+                    _, evicted = self.texts.popitem(last=False)
+                    self.cached_bytes -= len(evicted)
+        return text
+
+    def get_index(self, digest: str) -> ChunkIndex:
+        with self.lock:
+            index = self.indexes.get(digest)
+        if index is None:
+            file_name = self.get_file(digest)
+            if not os.path.exists(file_name):
+                raise Exception(f"Could not find document {digest} in {self.directory}")
+            index = ChunkIndex.from_file(file_name)
+            with self.lock:
+                index = self.indexes.setdefault(digest, index)
+        return index
+
+    def expand(self, text: str, query: str = None) -> str:
+        # Replace every reference with the document text, or with the excerpts most relevant to query
+        if not has_references(text):
+            return text
+        def replace(m):
+            if m.group(1) == 'excerpts':
+                excerpts = self.get_index(m.group(2)).excerpts(query, self.top_k)
+                return '\n...\n'.join(excerpts)
+            return self.get(m.group(2))
+        return REFERENCE_PATTERN.sub(replace, text)
+
+    def expand_messages(self, messages: List[dict]) -> List[dict]:
+        # API payload with the documents filled in, messages without references are passed through as they are.
+        # Excerpts are picked for the last user message, the one being responded to.
+        query = next((msg["content"] for msg in reversed(messages) if msg["role"] == 'user'), None)
+        expanded = []
+        for msg in messages:
+            if has_references(msg["content"]):
+                msg = { "role": msg["role"], "content": self.expand(msg["content"], query) }
+            expanded.append(msg)
+        return expanded
+
+    def preview(self, text: str) -> str:
+        # Collapsed form of the documents for display: name, size and the first few lines
+        if not has_references(text):
+            return text
+        return REFERENCE_PATTERN.sub(lambda m: self.get_preview(m.group(2), m.group(3), m.group(1)), text)
+
+    def get_preview(self, digest: str, name: str = None, kind: str = 'document') -> str:
+        if (digest, kind) not in self.previews:
+            file_name = self.get_file(digest)
+            if not os.path.exists(file_name):
+                return f"[Missing document {name or digest[:12]}]"
+            size = os.path.getsize(file_name)
+            with open(file_name, 'r', encoding='utf-8', errors='replace') as f:
+                head = f.read(PREVIEW_CHARS)
+            ellipsis = '...' if size > len(head.encode('utf-8')) else ''
+            excerpts = ', only relevant excerpts are sent' if kind == 'excerpts' else ''
+            self.previews[(digest, kind)] = f"[Document {name or digest[:12]}, {size} bytes{excerpts}]\n{head}{ellipsis}"
+        return self.previews[(digest, kind)]
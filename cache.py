@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+class CompletionCache:
+    # Responses stored on disk under a hash of the request (model, temperature, max_tokens and messages).
+    # The least recently used entries are evicted once the cache grows past max_bytes.
+
+    def __init__(self, directory: str = 'cache', max_bytes: int = 100 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()  # Requests run on several worker threads
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Map keys to file sizes, least recently used first. The file modification time records the last use.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        files = []
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.json'):
+                stat = os.stat(os.path.join(directory, file_name))
+                files.append((stat.st_mtime, file_name[:-5], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def make_key(self, config: dict) -> str:
+        data = json.dumps(config, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get_file(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self.get_file(key), 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except Exception:
+                self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            os.utime(self.get_file(key))
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, content: str, usage: dict):
+        data = json.dumps({ 'content': content, 'usage': usage }, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            with open(self.get_file(key), 'wb') as f:
+                f.write(data)
+            self.entries[key] = len(data)
+            self.total_bytes += len(data)
+            self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.get_file(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for key in self.entries:
+                try:
+                    os.remove(self.get_file(key))
+                except OSError:
+                    pass
+            self.entries = OrderedDict()
+            self.total_bytes = 0
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
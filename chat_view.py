@@ -0,0 +1,354 @@
+from bisect import bisect_right
+from typing import Dict, List
+
+import tkinter as tk
+import tkinter.font as tkfont
+from tkinter import ttk
+
+from metrics import metrics
+
+BOX_WIDTH = 90  # Width of a message box in characters
+BOX_GAP = 10  # Space between two message boxes
+FRAME_PADDING = 14  # Border and padding around the text of a box
+TEXT_PADDING = 6  # Border and padding inside the text widget
+CONTROLS_HEIGHT = 30  # Height of the edit button / branch menu column
+VIEWPORT_MARGIN = 400  # Pixels above and below the viewport that are materialized ahead of scrolling
+
+def count_lines(message: str):
+    # Calculate the number of lines
+    num_lines = message.count("\n")
+
+    # Calculate the total word wraps
+    total_word_wraps = 0
+    for num_wraps in [len(line) // BOX_WIDTH for line in message.split('\n')]:
+        total_word_wraps += num_wraps
+    return max(1, num_lines + total_word_wraps)
+
+def branch_label(index: int, node):
+    # select_branch reads the number back from the second word
+    if node.info is not None and node.info.get('model'):
+        return f"Branch {index + 1} ({node.info['model']})"
+    return f"Branch {index + 1}"
+
+def info_text(info: dict):
+    parts = [info.get('model', '')]
+    if info.get('cached'):
+        parts.append('cached')
+    elif info.get('latency') is not None:
+        parts.append(f"{info['latency']:.1f}s")
+    usage = info.get('usage') or {}
+    if usage.get('completion_tokens'):
+        parts.append(f"{usage['prompt_tokens']}+{usage['completion_tokens']} tokens")
+    return '\n'.join(part for part in parts if part)
+
+class ViewItem:
+    # One message box in the view, either a node or a response that is still streaming in
+    def __init__(self, key, node=None, role: str = 'assistant', text: str = '', parent=None):
+        self.key = key
+        self.node = node
+        self.role = role
+        self.text = text
+        self.parent = parent  # Node a pending response belongs to
+        self.lines = count_lines(text)
+        self.height = 0
+        self.measured = False
+
+    @property
+    def pending(self):
+        return self.node is None
+
+class MessageSlot:
+    # A recycled message box, bound to whichever item is scrolled into its position
+    def __init__(self, view):
+        self.view = view
+        self.item: ViewItem = None
+        self.frame = tk.Frame(view.canvas, bd=2, relief='groove', padx=5, pady=5)
+        self.text = tk.Text(self.frame, wrap='word', width=BOX_WIDTH, height=1)
+        self.text.pack(side='left', fill='both', expand=True)
+        self.controls_frame = tk.Frame(self.frame)
+        self.controls_frame.pack(side='right', fill='y')
+        self.edit_button = tk.Button(self.controls_frame, text='Edit', command=self.on_edit)
+        self.info_label = tk.Label(self.controls_frame, font=('TkDefaultFont', 8), justify='left')
+        self.selected_branch = tk.StringVar()
+        self.branch_menu = ttk.Combobox(self.controls_frame, textvariable=self.selected_branch, state='readonly')
+        self.branch_menu.bind('<<ComboboxSelected>>', self.on_branch_selected)
+        self.window = view.canvas.create_window(5, 0, window=self.frame, anchor='nw', state='hidden')
+
+    def bind(self, item: ViewItem):
+        self.item = item
+        self.text.config(state='normal', bg='#f0f0f0' if item.role == 'assistant' else '#e0ffe0', height=item.lines)
+        self.text.delete('1.0', tk.END)
+        self.text.insert('1.0', item.text)
+        self.text.config(state='disabled')
+        self.update_controls()
+        self.view.canvas.itemconfigure(self.window, state='normal')
+
+    def update_controls(self):
+        node = self.item.node
+        self.edit_button.pack_forget()
+        self.branch_menu.pack_forget()
+        self.info_label.pack_forget()
+        if node is None:
+            return
+        if node.role == 'user':
+            self.edit_button.pack(side='top')
+        children = node.parent.children
+        if len(children) > 1:
+            # If multiple branches exist, provide a dropdown to select
+            branch_options = [branch_label(i, child) for i, child in enumerate(children)]
+            self.branch_menu.config(values=branch_options)
+            self.selected_branch.set(branch_options[node.parent.selected_child_index()])
+            self.branch_menu.pack(side='top')
+        if node.info is not None:
+            self.info_label.config(text=info_text(node.info))
+            self.info_label.pack(side='top')
+
+    def append_text(self, text: str):
+        self.text.config(state='normal', height=self.item.lines)
+        self.text.insert(tk.END, text)
+        self.text.config(state='disabled')
+
+    def release(self):
+        self.item = None
+        self.view.canvas.itemconfigure(self.window, state='hidden')
+
+    def on_edit(self):
+        if self.item is not None:
+            self.view.on_edit(self.item.node)
+
+    def on_branch_selected(self, event):
+        if self.item is not None:
+            self.view.on_select_branch(self.item.node, self.selected_branch.get())
+
+class ChatView:
+    # Scrollable list of message boxes that only materializes the boxes near the viewport.
+    # Positions are computed from estimated heights, which are corrected once a box has been drawn.
+    items: List[ViewItem]
+    offsets: List[int]
+    positions: Dict[object, int]
+    slots: List[MessageSlot]
+
+    def __init__(self, master: tk.Widget, on_edit, on_select_branch, format_message=None):
+        self.on_edit = on_edit
+        self.on_select_branch = on_select_branch
+        self.format_message = format_message  # Turns a node's message into the text shown, e.g. to collapse documents
+
+        # Canvas for scrolling
+        self.canvas = tk.Canvas(master)
+        self.canvas.pack(side='left', fill='both', expand=True)
+
+        # Scrollbar for canvas
+        self.scrollbar = tk.Scrollbar(master, orient='vertical', command=self.yview)
+        self.scrollbar.pack(side='right', fill='y')
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.bind('<Configure>', lambda e: self.schedule_render())
+
+        self.line_height = tkfont.nametofont('TkFixedFont').metrics('linespace')
+        self.items = []
+        self.offsets = []  # Top of every item on the canvas
+        self.positions = {}  # Map item keys to their index in items
+        self.slots = []
+        self.total_height = 0
+        self.follow_bottom = True  # Keep the newest message in view until the user scrolls
+        self.render_scheduled = False
+
+    def estimate_height(self, item: ViewItem):
+        text_height = item.lines * self.line_height + TEXT_PADDING
+        if item.node is not None:
+            # The edit button, the branch menu and the response info are stacked next to the text
+            controls = (item.node.role == 'user') + (len(item.node.parent.children) > 1) + 2 * (item.node.info is not None)
+            text_height = max(text_height, controls * CONTROLS_HEIGHT)
+        return text_height + FRAME_PADDING
+
+    def contains(self, node):
+        return node.key in self.positions
+
+    def append(self, node):
+        self.extend([node])
+
+    def extend(self, nodes):
+        # Add a batch of messages with a single layout pass
+        start = len(self.items)
+        for node in nodes:
+            if node.key in self.positions:
+                continue
+            self.add_item(ViewItem(node.key, node, node.role, self.get_text(node)))
+        self.layout(start)
+        self.scroll_to_bottom()
+
+    def get_text(self, node):
+        if self.format_message is None:
+            return node.message
+        return self.format_message(node.message)
+
+    def add_item(self, item: ViewItem):
+        item.height = self.estimate_height(item)
+        self.positions[item.key] = len(self.items)
+        self.items.append(item)
+
+    def truncate_after(self, node):
+        # Remove every message after node, responses still streaming in for node itself stay. The root is never
+        # shown, everything comes after it.
+        if node.key in self.positions:
+            index = self.positions[node.key] + 1
+        elif node.parent is None:
+            index = 0
+        else:
+            return
+        kept = [item for item in self.items[index:] if item.pending and item.parent is node]
+        for item in self.items[index:]:
+            del self.positions[item.key]
+        del self.items[index:]
+        for item in kept:
+            self.add_item(item)
+        self.layout(index)
+
+    def refresh(self, node):
+        # Redraw a message, e.g. after a new branch was added next to it
+        if node.key not in self.positions:
+            return
+        index = self.positions[node.key]
+        item = self.items[index]
+        item.height = self.estimate_height(item)
+        item.measured = False
+        for slot in self.slots:
+            if slot.item is item:
+                slot.update_controls()
+        self.layout(index)
+
+    def add_pending(self, request_id: int, parent):
+        self.add_item(ViewItem(('pending', request_id), parent=parent))
+        self.layout(len(self.items) - 1)
+        self.scroll_to_bottom()
+
+    def append_pending(self, request_id: int, text: str):
+        # The box is gone if the user moved away from the branch, the text still ends up in the node
+        key = ('pending', request_id)
+        if key not in self.positions:
+            return
+        index = self.positions[key]
+        item = self.items[index]
+        item.text += text
+        lines = count_lines(item.text)
+        resized = lines != item.lines
+        item.lines = lines
+        for slot in self.slots:
+            if slot.item is item:
+                slot.append_text(text)
+        if resized:
+            item.height = self.estimate_height(item)
+            item.measured = False
+            self.layout(index)
+        if self.follow_bottom:
+            self.scroll_to_bottom()
+
+    def replace_pending(self, request_id: int, node) -> bool:
+        # The finished response takes the place of the box it streamed into, boxes still streaming below it stay below
+        key = ('pending', request_id)
+        if key not in self.positions or node.key in self.positions:
+            return False
+        index = self.positions.pop(key)
+        item = ViewItem(node.key, node, node.role, self.get_text(node))
+        item.height = self.estimate_height(item)
+        self.items[index] = item
+        self.positions[node.key] = index
+        self.layout(index)
+        return True
+
+    def remove_pending(self, request_id: int):
+        key = ('pending', request_id)
+        if key not in self.positions:
+            return
+        index = self.positions.pop(key)
+        del self.items[index]
+        for i in range(index, len(self.items)):
+            self.positions[self.items[i].key] = i
+        self.layout(index)
+
+    def clear(self):
+        self.items = []
+        self.positions = {}
+        self.layout(0)
+
+    def layout(self, start: int = 0):
+        # Recompute item positions from start onwards, this is plain arithmetic and does not touch any widget
+        del self.offsets[start:]
+        y = self.offsets[-1] + self.items[start - 1].height + BOX_GAP if start > 0 else 0
+        for item in self.items[start:]:
+            self.offsets.append(y)
+            y += item.height + BOX_GAP
+        self.total_height = y
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), max(y, 1)))
+        self.schedule_render()
+
+    def schedule_render(self):
+        # Coalesce every change made in the same event into one render pass
+        if not self.render_scheduled:
+            self.render_scheduled = True
+            self.canvas.after_idle(self.render)
+
+    def visible_range(self):
+        top = self.canvas.canvasy(0) - VIEWPORT_MARGIN
+        bottom = self.canvas.canvasy(0) + self.canvas.winfo_height() + VIEWPORT_MARGIN
+        first = max(0, bisect_right(self.offsets, top) - 1)
+        last = bisect_right(self.offsets, bottom)
+        return first, last
+
+    def render(self):
+        self.render_scheduled = False
+        with metrics.timed('render'):
+            self.render_slots()
+
+    def render_slots(self):
+        if self.follow_bottom:
+            self.canvas.yview_moveto(1)
+        first, last = self.visible_range()
+        visible = set(range(first, last))
+
+        # Release slots whose item scrolled out of view or was removed
+        bound = {}
+        for slot in self.slots:
+            if slot.item is None:
+                continue
+            index = self.positions.get(slot.item.key)
+            if index is None or index not in visible or self.items[index] is not slot.item:
+                slot.release()
+            else:
+                bound[index] = slot
+
+        free = [slot for slot in self.slots if slot.item is None]
+        for index in range(first, last):
+            if index not in bound:
+                slot = free.pop() if free else self.new_slot()
+                slot.bind(self.items[index])
+                bound[index] = slot
+            self.canvas.coords(bound[index].window, 5, self.offsets[index])
+
+        # Correct the estimated heights with the drawn ones, in a single pass for the whole batch
+        unmeasured = [index for index, slot in bound.items() if not self.items[index].measured]
+        if unmeasured:
+            self.canvas.update_idletasks()
+            changed = None
+            for index in unmeasured:
+                item = self.items[index]
+                height = bound[index].frame.winfo_reqheight()
+                item.measured = True
+                if height != item.height:
+                    item.height = height
+                    changed = index if changed is None else min(changed, index)
+            if changed is not None:
+                self.layout(changed)
+
+    def new_slot(self):
+        slot = MessageSlot(self)
+        self.slots.append(slot)
+        return slot
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.follow_bottom = self.canvas.yview()[1] >= 1.0
+        self.schedule_render()
+
+    def scroll_to_bottom(self):
+        self.follow_bottom = True
+        self.schedule_render()
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+
+import numpy as np
+
+from archive import ConversationArchive
+from tokens import TOKENS_PER_MESSAGE, count_message_tokens
+
+# Flattens the archive into one row per node, as NumPy arrays written to .npz (or Parquet with pyarrow), and runs
+# usage reports over them without walking any tree. Saved files in completions/ that are not in the archive yet are
+# imported first.
+#
+#   python export.py --output nodes.npz
+#   python export.py --load nodes.npz
+
+ROLES = ['system', 'user', 'assistant']
+CATEGORIES = { 'role': 'role_names', 'model': 'model_names' }  # Columns stored as codes into a list of names
+
+def parse_time(saved: str) -> float:
+    try:
+        return datetime.datetime.fromisoformat(saved).timestamp()
+    except (TypeError, ValueError):
+        return float('nan')
+
+def read_archive(archive: ConversationArchive, exact_tokens: bool = False) -> dict:
+    # Nodes are read in the order they were saved, parents before their children, so parent indexes and depths
+    # come out of a single pass
+    conversations = { id: (model or '', parse_time(saved)) for id, model, saved in archive.db.execute('SELECT id, model, saved FROM conversations') }
+    text = 'message' if exact_tokens else 'NULL'
+    cursor = archive.db.execute(f'''SELECT conversation_id, id, parent_id, position, role, length(message), selected_child_id, info, {text}
+                                    FROM nodes ORDER BY rowid''')
+    index = {}
+    selected_ids = []
+    model_codes = { '': 0 }  # Code 0 is a node without a model, e.g. a user message
+    role_codes = { role: code for code, role in enumerate(ROLES) }
+    conversation, parent, depth, position, role, model, selected = [], [], [], [], [], [], []
+    chars, tokens, prompt_tokens, completion_tokens, latency, cached, times, saved = [], [], [], [], [], [], [], []
+    for conversation_id, id, parent_id, node_position, node_role, length, selected_child_id, info, message in cursor:
+        row = len(conversation)
+        index[(conversation_id, id)] = row
+        parent_row = index.get((conversation_id, parent_id), -1) if parent_id is not None else -1
+        info = json.loads(info) if info else {}
+        usage = info.get('usage') or {}
+        conversation_model, saved_time = conversations.get(conversation_id, ('', float('nan')))
+        # Responses from before they were tagged are put down to the model the conversation was saved with
+        model_name = info.get('model') or (conversation_model if node_role == 'assistant' else '')
+        conversation.append(conversation_id)
+        parent.append(parent_row)
+        depth.append(depth[parent_row] + 1 if parent_row >= 0 else 0)
+        position.append(node_position)
+        role.append(role_codes.setdefault(node_role, len(role_codes)))
+        model.append(model_codes.setdefault(model_name, len(model_codes)))
+        selected.append(parent_row >= 0 and selected_ids[parent_row] == id)
+        selected_ids.append(selected_child_id)
+        chars.append(length)
+        if exact_tokens:
+            tokens.append(count_message_tokens(message))
+        prompt_tokens.append(usage.get('prompt_tokens', 0))
+        completion_tokens.append(usage.get('completion_tokens', 0))
+        latency.append(info.get('latency', float('nan')))
+        cached.append(info.get('cached', False))
+        times.append(info.get('time', float('nan')))
+        saved.append(saved_time)
+    parent = np.array(parent, dtype=np.int32)
+    chars = np.array(chars, dtype=np.int32)
+    return {
+        'conversation': np.array(conversation, dtype=np.int32),
+        'parent': parent,
+        'depth': np.array(depth, dtype=np.int32),
+        'position': np.array(position, dtype=np.int32),
+        'children': np.bincount(parent[parent >= 0], minlength=len(parent)).astype(np.int32),
+        'role': np.array(role, dtype=np.int8),
+        'model': np.array(model, dtype=np.int16),
+        'selected': np.array(selected, dtype=bool),
+        'chars': chars,
+        # Without exact counts, the estimate tokens.py uses without tiktoken
+        'tokens': np.array(tokens, dtype=np.int32) if exact_tokens else (chars + 3) // 4 + TOKENS_PER_MESSAGE,
+        'prompt_tokens': np.array(prompt_tokens, dtype=np.int32),
+        'completion_tokens': np.array(completion_tokens, dtype=np.int32),
+        'latency': np.array(latency, dtype=np.float32),
+        'cached': np.array(cached, dtype=bool),
+        'time': np.array(times, dtype=np.float64),  # When the response arrived, NaN if not recorded
+        'saved': np.array(saved, dtype=np.float64),  # When the conversation was saved
+        'role_names': np.array(list(role_codes)),
+        'model_names': np.array(list(model_codes)),
+    }
+
+def write_columns(columns: dict, file_name: str):
+    if file_name.endswith('.parquet'):
+        # pyarrow is optional, the codes become dictionary encoded string columns
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception('Writing Parquet needs pyarrow, install it or write a .npz file instead')
+        arrays = {}
+        for name, values in columns.items():
+            if name in CATEGORIES.values():
+                continue
+            if name in CATEGORIES:
+                values = pa.DictionaryArray.from_arrays(values.astype(np.int32), pa.array(columns[CATEGORIES[name]].tolist()))
+            arrays[name] = values
+        pq.write_table(pa.table(arrays), file_name)
+    else:
+        np.savez_compressed(file_name, **columns)
+
+def read_columns(file_name: str) -> dict:
+    if file_name.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception('Reading Parquet needs pyarrow')
+        table = pq.read_table(file_name)
+        columns = {}
+        for name in table.column_names:
+            column = table.column(name).combine_chunks()
+            if name in CATEGORIES:
+                columns[name] = column.indices.to_numpy()
+                columns[CATEGORIES[name]] = np.array(column.dictionary.to_pylist())
+            else:
+                columns[name] = column.to_numpy(zero_copy_only=False)
+        return columns
+    with np.load(file_name) as data:
+        return { name: data[name] for name in data.files }
+
+def report(columns: dict) -> dict:
+    # Every figure is a handful of array operations over all rows, nothing loops over the nodes
+    role = columns['role']
+    model = columns['model']
+    parent = columns['parent']
+    model_names = columns['model_names']
+    role_names = list(columns['role_names'])
+    n = len(role)
+    user = role == role_names.index('user')
+    assistant = role == role_names.index('assistant')
+
+    # Tokens and latency per model
+    responses = np.bincount(model[assistant], minlength=len(model_names))
+    prompt = np.bincount(model[assistant], weights=columns['prompt_tokens'][assistant], minlength=len(model_names))
+    completion = np.bincount(model[assistant], weights=columns['completion_tokens'][assistant], minlength=len(model_names))
+    timed = assistant & np.isfinite(columns['latency']) & ~columns['cached']
+    latency_sum = np.bincount(model[timed], weights=columns['latency'][timed], minlength=len(model_names))
+    latency_count = np.bincount(model[timed], minlength=len(model_names))
+    models = {}
+    for code in np.flatnonzero(responses):
+        models[str(model_names[code]) or 'unknown'] = {
+            'responses': int(responses[code]),
+            'prompt_tokens': int(prompt[code]),
+            'completion_tokens': int(completion[code]),
+            'mean_latency': round(float(latency_sum[code] / latency_count[code]), 3) if latency_count[code] else None,
+        }
+
+    # Branching: how many children the nodes that have any have. A user message with several responses was
+    # regenerated or compared, a message with several user replies had one of them edited.
+    children = columns['children']
+    branching = np.bincount(children[children > 0]) if n else np.zeros(0, dtype=np.int64)
+    has_parent = parent >= 0
+    responses_per_node = np.bincount(parent[assistant & has_parent], minlength=n)
+    replies_per_node = np.bincount(parent[user & has_parent], minlength=n)
+    answered = responses_per_node[user] > 0
+    replied = replies_per_node > 0
+
+    # Depth and size per conversation
+    _, conversation_index = np.unique(columns['conversation'], return_inverse=True)
+    count = int(conversation_index.max()) + 1 if n else 0
+    max_depth = np.zeros(count, dtype=np.int32)
+    np.maximum.at(max_depth, conversation_index, columns['depth'])
+    sizes = np.bincount(conversation_index, minlength=count)
+
+    # Completion tokens per day, by response time or else the time the conversation was saved
+    when = np.where(np.isfinite(columns['time']), columns['time'], columns['saved'])
+    dated = assistant & np.isfinite(when)
+    days, day_index = np.unique((when[dated] // 86400).astype(np.int64), return_inverse=True)
+    day_tokens = np.bincount(day_index, weights=columns['completion_tokens'][dated], minlength=len(days))
+    day_responses = np.bincount(day_index, minlength=len(days))
+
+    def percentiles(values):
+        if len(values) == 0:
+            return None
+        result = { f'p{p}': float(np.percentile(values, p)) for p in (50, 90, 99) }
+        result['max'] = int(values.max())
+        return result
+
+    return {
+        'conversations': count,
+        'nodes': n,
+        'roles': { name: int(total) for name, total in zip(role_names, np.bincount(role, minlength=len(role_names))) },
+        'models': models,
+        'tokens': {
+            'prompt': int(columns['prompt_tokens'].sum()),
+            'completion': int(columns['completion_tokens'].sum()),
+            'messages': int(columns['tokens'].sum()),
+            'off_selected_path': int(columns['tokens'][~columns['selected'] & has_parent].sum()),
+        },
+        'branching': {
+            'mean': round(float(children[children > 0].mean()), 3) if branching.sum() else None,
+            'distribution': { str(k): int(total) for k, total in enumerate(branching) if total },
+        },
+        'regen_rate': round(float((responses_per_node[user][answered] > 1).mean()), 4) if answered.any() else None,
+        'edit_rate': round(float((replies_per_node[replied] > 1).mean()), 4) if replied.any() else None,
+        'conversation_depth': percentiles(max_depth),
+        'conversation_nodes': percentiles(sizes),
+        'by_day': {
+            datetime.date.fromtimestamp(day * 86400).isoformat(): { 'responses': int(total), 'completion_tokens': int(tokens) }
+            for day, total, tokens in zip(days, day_responses, day_tokens)
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the archive as one row per node and report on token usage and branching')
+    parser.add_argument('--archive', default='completions/archive.db')
+    parser.add_argument('--directory', default='completions', help='saved conversations to import into the archive first')
+    parser.add_argument('--output', help='file to write the columns to, .npz or .parquet (needs pyarrow)')
+    parser.add_argument('--load', help='report on a file written by an earlier export instead of reading the archive')
+    parser.add_argument('--exact-tokens', action='store_true', help='count the tokens of every message instead of estimating them from its length')
+    parser.add_argument('--report', help='file to write the report to as JSON')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.load:
+        columns = read_columns(args.load)
+    else:
+        archive = ConversationArchive(args.archive)
+        if os.path.exists(args.directory):
+            archive.import_directory(args.directory)
+        columns = read_archive(archive, args.exact_tokens)
+        archive.close()
+        if args.output:
+            write_columns(columns, args.output)
+    loaded = time.perf_counter()
+    result = report(columns)
+    print(f'{len(columns["role"])} nodes read in {loaded - start:.2f}s, report in {time.perf_counter() - loaded:.2f}s', file=sys.stderr)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4)
+    print(json.dumps(result, indent=4))
+
+if __name__ == '__main__':
+    main()
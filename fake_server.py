@@ -0,0 +1,160 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from tokens import count_prompt_tokens
+
+# Local stand-in for the chat completions API, for load tests and trying the app without a key. It answers every
+# request with filler text, streamed or not, reports usage and can be made slow or flaky:
+#
+#   python fake_server.py --port 8000 --latency 0.3 --error-rate 0.02 --rate-limit-rate 0.05
+#
+# and then point a client at it with base_url http://127.0.0.1:8000/v1 (e.g. "base_url" in config.json).
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+
+class FakeSettings:
+    def __init__(self, latency: float = 0.2, token_delay: float = 0.005, response_tokens: int = 100, error_rate: float = 0,
+                 rate_limit_rate: float = 0, retry_after: float = 1, requests_per_minute: int = 10000, tokens_per_minute: int = 10000000):
+        self.latency = latency  # Seconds before the first token
+        self.token_delay = token_delay  # Seconds between streamed tokens
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate  # Share of requests answered with a 500
+        self.rate_limit_rate = rate_limit_rate  # Share of requests answered with a 429
+        self.retry_after = retry_after
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so clients can reuse their connections like with the real API
+    settings: FakeSettings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, { 'object': 'list', 'data': [{ 'id': 'gpt-4o', 'object': 'model', 'owned_by': 'fake' }] })
+        else:
+            self.send_json(404, { 'error': { 'message': f'Unknown path {self.path}', 'type': 'invalid_request_error' } })
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, { 'error': { 'message': f'Unknown path {self.path}', 'type': 'invalid_request_error' } })
+            return
+        settings = self.settings
+        request = json.loads(body)
+        roll = random.random()
+        with settings.lock:
+            settings.requests += 1
+            if roll < settings.rate_limit_rate:
+                settings.rate_limited += 1
+            elif roll < settings.rate_limit_rate + settings.error_rate:
+                settings.errors += 1
+        if roll < settings.rate_limit_rate:
+            self.send_json(429, { 'error': { 'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded' } },
+                           { 'retry-after-ms': str(int(settings.retry_after * 1000)) })
+            return
+        if roll < settings.rate_limit_rate + settings.error_rate:
+            self.send_json(500, { 'error': { 'message': 'The server had an error', 'type': 'server_error' } })
+            return
+
+        time.sleep(settings.latency)
+        max_tokens = request.get('max_tokens') or settings.response_tokens
+        words = [random.choice(WORDS) for _ in range(min(settings.response_tokens, max_tokens))]
+        prompt_tokens = count_prompt_tokens(request.get('messages', []))
+        usage = { 'prompt_tokens': prompt_tokens, 'completion_tokens': len(words), 'total_tokens': prompt_tokens + len(words) }
+        base = { 'id': f'chatcmpl-fake{settings.requests}', 'created': int(time.time()), 'model': request.get('model', 'gpt-4o') }
+        if request.get('stream'):
+            self.stream(request, base, words, usage)
+            return
+        self.send_json(200, dict(base, object='chat.completion', usage=usage, choices=[{
+            'index': 0,
+            'message': { 'role': 'assistant', 'content': ' '.join(words) },
+            'finish_reason': 'stop',
+        }]))
+
+    def stream(self, request: dict, base: dict, words, usage: dict):
+        # Server-sent events in chunked transfer encoding, one word per chunk, then the usage if it was asked for
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_rate_limit_headers()
+        self.end_headers()
+        def event(data):
+            payload = f'data: {data}\n\n'.encode('utf-8')
+            self.wfile.write(f'{len(payload):x}\r\n'.encode('ascii') + payload + b'\r\n')
+            self.wfile.flush()
+        chunk = dict(base, object='chat.completion.chunk')
+        event(json.dumps(dict(chunk, choices=[{ 'index': 0, 'delta': { 'role': 'assistant', 'content': '' }, 'finish_reason': None }])))
+        for i, word in enumerate(words):
+            if i > 0:
+                time.sleep(self.settings.token_delay)
+            event(json.dumps(dict(chunk, choices=[{ 'index': 0, 'delta': { 'content': word if i == 0 else ' ' + word }, 'finish_reason': None }])))
+        event(json.dumps(dict(chunk, choices=[{ 'index': 0, 'delta': {}, 'finish_reason': 'stop' }])))
+        if request.get('stream_options', {}).get('include_usage'):
+            event(json.dumps(dict(chunk, choices=[], usage=usage)))
+        event('[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def send_json(self, status: int, data: dict, headers: dict = None):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_rate_limit_headers()
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_rate_limit_headers(self):
+        self.send_header('x-ratelimit-limit-requests', str(self.settings.requests_per_minute))
+        self.send_header('x-ratelimit-limit-tokens', str(self.settings.tokens_per_minute))
+
+def start_server(settings: FakeSettings, host: str = '127.0.0.1', port: int = 0):
+    # Serves on a background thread and returns the server, its base_url is http://host:server.server_port/v1
+    handler = type('Handler', (FakeHandler,), { 'settings': settings })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first token')
+    parser.add_argument('--token-delay', type=float, default=0.005, help='seconds between streamed tokens')
+    parser.add_argument('--response-tokens', type=int, default=100)
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests that fail with a 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0, help='share of requests that fail with a 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='seconds a 429 asks the client to wait')
+
+def settings_from_args(args) -> FakeSettings:
+    return FakeSettings(args.latency, args.token_delay, args.response_tokens, args.error_rate, args.rate_limit_rate, args.retry_after)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(settings_from_args(args), args.host, args.port)
+    print(f'Serving on http://{args.host}:{server.server_port}/v1, Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+if __name__ == '__main__':
+    main()
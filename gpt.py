@@ -2,9 +2,48 @@ import os
 import json
 import time
 import datetime
+import threading
 from typing import List
 
-from openai import OpenAI
+from tokens import count_prompt_tokens, get_context_limit
+from ratelimit import get_limiter
+
+class RequestCancelled(Exception):
+    pass
+
+class ContextOverflow(Exception):
+    pass
+
+_clients = {}
+_clients_lock = threading.Lock()
+_prompts = {}
+
+def get_openai_client(api_key: str, base_url: str = None):
+    # One client per key and server for the whole process. It keeps its pool of open connections across chats and
+    # resets, so only the first request pays for the connection setup. openai is slow to import and only imported here.
+    with _clients_lock:
+        if (api_key, base_url) not in _clients:
+            from openai import OpenAI
+            # Retries are left to the rate limiter. Without a base_url the SDK uses OPENAI_BASE_URL or the OpenAI API.
+            _clients[(api_key, base_url)] = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        return _clients[(api_key, base_url)]
+
+def read_system_prompt(file_name: str) -> str:
+    # Only read again when the file changed on disk
+    if not os.path.exists(file_name):
+        raise Exception(f"Could not find sys prompt file at {file_name}")
+    mtime = os.path.getmtime(file_name)
+    if file_name not in _prompts or _prompts[file_name][0] != mtime:
+        with open(file_name, 'r', encoding='utf-8') as f:
+            _prompts[file_name] = (mtime, f.read())
+    return _prompts[file_name][1]
+
+def warm_up(api_key: str, base_url: str = None):
+    # Imports openai and opens a connection ahead of the first message, meant to run on a background thread
+    try:
+        get_openai_client(api_key, base_url).models.list()
+    except Exception as e:
+        print(f'Could not warm up the connection\n{e}')
 
 class Message:
     role: str
@@ -23,17 +62,27 @@ class Message:
 class GptChat:
     messages: List[Message]
 
-    def __init__(self, system_prompt_file: str, api_key: str) -> None:
-        if not os.path.exists(system_prompt_file):
-            raise Exception(f"Could not find sys prompt file at {system_prompt_file}")
-        with open(system_prompt_file, 'r', encoding='utf-8') as f:
-            self.system_prompt = f.read()
-        
+    def __init__(self, system_prompt_file: str, api_key: str, base_url: str = None) -> None:
+        self.system_prompt = read_system_prompt(system_prompt_file)
         self.model = 'gpt-4o'
-        self.openai_client = OpenAI(api_key=api_key)
+        self.api_key = api_key
+        self.base_url = base_url  # Any OpenAI compatible server, e.g. fake_server.py
+        self._openai_client = None  # The shared client for api_key unless one is set
         self.messages = []
         self.reset_chat()
         self.total_tokens = 0
+        self.cache = None  # Optional CompletionCache for responses
+        self.verbose = True  # Print the token usage and the retries of every request
+
+    @property
+    def openai_client(self):
+        if self._openai_client is None:
+            self._openai_client = get_openai_client(self.api_key, self.base_url)
+        return self._openai_client
+
+    @openai_client.setter
+    def openai_client(self, client):
+        self._openai_client = client
 
     def to_obj_list(self):
         l = []
@@ -63,36 +112,172 @@ class GptChat:
         self.messages = [ ]
         self.add_message("system", self.system_prompt)
 
-    def send(self, message: str, max_tokens=1000) -> str:
-        if self.total_tokens >= 64000 - max_tokens:
-            raise "Chat Error too many tokens"
-        
-        self.add_message("user", message)
-        messages = self.to_obj_list()
-        if 'o1' in self.model:
+    def get_config(self, messages: List[dict], max_tokens: int, model: str = None):
+        model = model or self.model
+        if 'o1' in model:
             messages = messages[1:]
         
         defaultConfig = {
-            "model": self.model,
+            "model": model,
             "max_tokens": max_tokens,
             "messages": messages,
             "temperature": 0.5
         }
 
-        if 'o1' in self.model:
+        if 'o1' in model:
             del defaultConfig["temperature"]
             del defaultConfig["max_tokens"]
+        return defaultConfig
+
+    def context_limit(self, model: str = None) -> int:
+        return get_context_limit(model or self.model)
+
+    def check_context(self, messages: List[dict], max_tokens: int, prompt_tokens: int = None, model: str = None) -> int:
+        # Checked before sending so an oversized prompt never costs a round trip, returns the size of the prompt
+        model = model or self.model
+        if prompt_tokens is None:
+            prompt_tokens = count_prompt_tokens(messages)
+        if prompt_tokens + max_tokens > self.context_limit(model):
+            raise ContextOverflow(f"Chat Error too many tokens: the prompt is {prompt_tokens} tokens and {model} allows {self.context_limit(model) - max_tokens}")
+        return prompt_tokens
+
+    def record_usage(self, usage, usage_out: dict = None):
+        if self.verbose:
+            print(f"Sending chat with {usage.prompt_tokens} tokens")
+            print(f"GPT API responded with {usage.completion_tokens} tokens. \nOverall, {usage.total_tokens} total tokens")
+        self.total_tokens = usage.total_tokens
+        if usage_out is not None:
+            usage_out['prompt_tokens'] = usage.prompt_tokens
+            usage_out['completion_tokens'] = usage.completion_tokens
+            usage_out['total_tokens'] = usage.total_tokens
 
+    def create_completion(self, config: dict, cancel: threading.Event = None, tokens: int = 0, stats: dict = None):
+        # Every request waits for the rate limiter of its model, which is shared by all threads. Only transient errors
+        # are retried, with jittered exponential backoff, until the retry budget of the limiter runs out.
+        limiter = get_limiter(config['model'])
+        attempt = 0
+        while True:
+            if not limiter.acquire(tokens, cancel):
+                raise RequestCancelled()
+            try:
+                raw = self.openai_client.chat.completions.with_raw_response.create(**config)
+            except Exception as e:
+                if not limiter.is_retryable(e) or attempt >= limiter.max_retries:
+                    raise
+                delay = limiter.on_error(e, attempt)
+                attempt += 1
+                if stats is not None:
+                    stats['retries'] = attempt
+                if self.verbose:
+                    print(f'Error when sending chat, retrying in {delay:.1f} seconds ({attempt}/{limiter.max_retries})\n{e}')
+                if cancel is None:
+                    time.sleep(delay)
+                elif cancel.wait(delay):
+                    raise RequestCancelled()
+                continue
+            limiter.update_from_headers(raw.headers)
+            return raw.parse()
+
+    def complete(self, messages: List[dict], max_tokens=1000, on_token=None, cancel: threading.Event = None, prompt_tokens: int = None,
+                 usage: dict = None, use_cache: bool = True, stats: dict = None, model: str = None) -> str:
+        # Sends the given message list without touching self.messages, so it is safe to call from worker threads.
+        # usage, when given, is filled with the token usage of this request, and stats with the time of the first
+        # token, whether it was streamed, the number of retries and whether the response came from the cache. model
+        # overrides self.model for this request only.
+        if usage is None:
+            usage = {}
+        if stats is None:
+            stats = {}
+        key = None
+        if self.cache is not None and use_cache:
+            key = self.cache.make_key(self.get_config(messages, max_tokens, model))
+            cached = self.cache.get(key)
+            if cached is not None:
+                stats['cache_hit'] = True
+                stats['first_token'] = time.time()
+                usage.update(cached['usage'])
+                if 'total_tokens' in usage:
+                    self.total_tokens = usage['total_tokens']
+                if on_token is not None:
+                    on_token(cached['content'])
+                return cached['content']
+
+        if on_token is not None:
+            chunks = []
+            for chunk in self.stream_completion(messages, max_tokens, cancel, prompt_tokens, usage, stats, model):
+                if not chunks:
+                    stats['first_token'] = time.time()
+                chunks.append(chunk)
+                on_token(chunk)
+            msg = ''.join(chunks).strip()
+        else:
+            prompt_tokens = self.check_context(messages, max_tokens, prompt_tokens, model)
+            config = self.get_config(messages, max_tokens, model)
+            res = self.create_completion(config, cancel, prompt_tokens + max_tokens, stats)
+            # The whole response arrives at once, the first token is the last one
+            stats['first_token'] = time.time()
+            stats['streamed'] = False
+            self.record_usage(res.usage, usage)
+            get_limiter(config['model']).refund(prompt_tokens + max_tokens, res.usage.total_tokens)
+            msg = res.choices[0].message.content.strip()
+
+        if key is not None:
+            self.cache.put(key, msg, usage)
+        return msg
+
+    def stream_completion(self, messages: List[dict], max_tokens=1000, cancel: threading.Event = None, prompt_tokens: int = None,
+                          usage: dict = None, stats: dict = None, model: str = None):
+        model = model or self.model
+        if 'o1' in model:
+            # o1 models do not support streaming, hand back the whole response as a single chunk
+            yield self.complete(messages, max_tokens, cancel=cancel, prompt_tokens=prompt_tokens, usage=usage, use_cache=False, stats=stats, model=model)
+            return
+
+        prompt_tokens = self.check_context(messages, max_tokens, prompt_tokens, model)
+        defaultConfig = self.get_config(messages, max_tokens, model)
+        defaultConfig["stream"] = True
+        defaultConfig["stream_options"] = { "include_usage": True }
+        res = self.create_completion(defaultConfig, cancel, prompt_tokens + max_tokens, stats)
+        if stats is not None:
+            stats['streamed'] = True
+
+        final_usage = None
+        for chunk in res:
+            if cancel is not None and cancel.is_set():
+                res.close()
+                raise RequestCancelled()
+            # The final chunk carries the usage and has no choices
+            if chunk.usage is not None:
+                final_usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+        if final_usage is not None:
+            self.record_usage(final_usage, usage)
+            get_limiter(model).refund(prompt_tokens + max_tokens, final_usage.total_tokens)
+
+    def send(self, message: str, max_tokens=1000, on_token=None) -> str:
+        # With on_token the response is streamed and every chunk is passed to the callback as it arrives
+        self.add_message("user", message)
         try:
-            res = self.openai_client.chat.completions.create(**defaultConfig)
-        except Exception as e:
-            print(f'Error when sending chat, retrying in one minute\n{e}')
-            time.sleep(60)
+            msg = self.complete(self.to_obj_list(), max_tokens, on_token)
+        except BaseException:
             self.messages = self.messages[:-1]
-            self.send(message, max_tokens)
-        msg = res.choices[0].message.content.strip()
-        print(f"Sending chat with {res.usage.prompt_tokens} tokens")
-        print(f"GPT API responded with {res.usage.completion_tokens} tokens. \nOverall, {res.usage.total_tokens} total tokens")
+            raise
         self.add_message("assistant", msg)
-        self.total_tokens = res.usage.total_tokens
-        return msg
\ No newline at end of file
+        return msg
+
+    def stream(self, message: str, max_tokens=1000):
+        # Generator over the response chunks, the full message is added to the chat once the stream ends
+        self.add_message("user", message)
+        chunks = []
+        try:
+            for chunk in self.stream_completion(self.to_obj_list(), max_tokens):
+                chunks.append(chunk)
+                yield chunk
+        except BaseException:
+            self.messages = self.messages[:-1]
+            raise
+        self.add_message("assistant", ''.join(chunks).strip())
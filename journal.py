@@ -0,0 +1,151 @@
+import os
+import json
+from typing import List
+
+from tree import MessageNode, ConversationTree, load_branch
+
+class ConversationJournal:
+    # Append-only log of the changes to the open conversation. Every event is fsync'd as it is written, and the log
+    # is folded into a snapshot every compact_every events, so the session survives a crash and is restored on startup.
+
+    def __init__(self, directory: str = 'journal', compact_every: int = 500, name: str = 'session'):
+        # Every open conversation has its own journal, told apart by name
+        self.directory = directory
+        self.journal_file = os.path.join(directory, f'{name}.jsonl')
+        self.snapshot_file = os.path.join(directory, f'{name}.json')
+        self.compact_every = compact_every
+        self.file = None
+        self.events = 0
+        self.tree: ConversationTree = None
+        self.snapshot = None  # Returns the serialized conversation when the journal is compacted
+
+    def attach(self, tree: ConversationTree, snapshot):
+        # Start journaling tree, starting from a fresh snapshot of it
+        if self.tree is not None:
+            self.tree.listener = None
+        self.tree = tree
+        self.snapshot = snapshot
+        tree.listener = self.on_tree_event
+        self.compact()
+
+    def on_tree_event(self, event: str, node: MessageNode):
+        data = { 'id': node.id }
+        if event == 'node_added':
+            data['parent_id'] = node.parent.id
+            data['role'] = node.role
+            data['message'] = node.message
+            data['selected'] = node.parent.selected_child is node
+            if node.info is not None:
+                data['info'] = node.info
+        elif event == 'branch_selected':
+            data['parent_id'] = node.parent.id
+        self.record(event, **data)
+
+    def record(self, event: str, **data):
+        if self.file is None:
+            return
+        data['event'] = event
+        if self.tree is not None:
+            data['current_id'] = self.tree.current_node.id
+        self.file.write(json.dumps(data) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.events += 1
+        if self.events >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if self.snapshot is not None:
+            # Write the snapshot next to the old one and swap it in, so there is always a complete copy on disk
+            tmp_file = self.snapshot_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_file, 'w', encoding='utf-8')
+        self.events = 0
+
+    def recover(self):
+        # Returns the last snapshot and the events logged after it, or None if there is no session to recover
+        if not os.path.exists(self.snapshot_file):
+            return None
+        with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+            try:
+                snapshot = json.load(f)
+            except Exception as e:
+                print(f'Could not read journal snapshot {self.snapshot_file}\n{e}')
+                return None
+        events = []
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except Exception:
+                        # The last line can be cut off by a crash
+                        break
+        return snapshot, events
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        # The conversation was closed for good, there is nothing left to recover
+        self.close()
+        if self.tree is not None:
+            self.tree.listener = None
+        for file_name in (self.journal_file, self.snapshot_file):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+def apply_events(tree: ConversationTree, events: List[dict]):
+    # Replay journaled events on a tree restored from the snapshot, returns the last model and token usage logged
+    # Replaying an event the snapshot already contains changes nothing, e.g. after a crash between writing the
+    # snapshot and emptying the journal
+    nodes = {}
+    stale = [True]  # The index misses branches that were loaded since it was built
+
+    def find(id: str) -> MessageNode:
+        # Branches loaded lazily during the replay are indexed when one of their nodes is first looked up
+        if id is not None and id not in nodes and stale[0]:
+            stack = [tree.root]
+            while stack:
+                node = stack.pop()
+                nodes[node.id] = node
+                stack.extend(node.children)
+            stale[0] = False
+        return nodes.get(id)
+
+    state = {}
+    for event in events:
+        kind = event['event']
+        if kind == 'node_added' and find(event['id']) is None and find(event['parent_id']) is not None:
+            node = MessageNode(event['message'], event['role'], id=event['id'], info=event.get('info'))
+            parent: MessageNode = nodes[event['parent_id']]
+            selected = parent.selected_child
+            parent.add_child(node)
+            if not event.get('selected', True) and selected is not None:
+                parent.selected_child = selected
+            nodes[node.id] = node
+        elif kind == 'branch_selected' and find(event['id']) is not None:
+            node = nodes[event['id']]
+            node.parent.selected_child = node
+            load_branch(node)
+            stale[0] = True
+        elif kind == 'node_removed' and find(event['id']) is not None:
+            node = nodes.pop(event['id'])
+            node.parent.remove_child(node)
+        elif kind == 'model_changed':
+            state['model'] = event['model']
+        elif kind == 'usage':
+            state['total_tokens'] = event['total_tokens']
+        if find(event.get('current_id')) is not None:
+            tree.current_node = nodes[event['current_id']]
+    return state
@@ -1,18 +1,28 @@
 import os
 import json
-import openai
 
-def get_key():
-    if not os.path.exists('config.json'):
-        raise "Cannot find config.json"
+_config = None
+_config_mtime = None
 
-    with open('config.json', 'r', encoding='utf-8') as f:
-        try:
-            config = json.load(f)
-        except:
-            raise "Could not load config.json"
+def get_config():
+    # config.json is only parsed again when it changed on disk
+    global _config, _config_mtime
+    if not os.path.exists('config.json'):
+        raise Exception("Cannot find config.json")
+    mtime = os.path.getmtime('config.json')
+    if _config is None or mtime != _config_mtime:
+        with open('config.json', 'r', encoding='utf-8') as f:
+            try:
+                config = json.load(f)
+            except Exception as e:
+                raise Exception(f"Could not load config.json\n{e}")
+        _config = config
+        _config_mtime = mtime
+    return _config
 
+def get_key():
+    config = get_config()
     if not 'openai_key' in config:
-        raise "Could not find \"openai_key\" in config.json"
+        raise Exception("Could not find \"openai_key\" in config.json")
 
-    return config['openai_key']
\ No newline at end of file
+    return config['openai_key']
@@ -0,0 +1,122 @@
+import sys
+import json
+import time
+import argparse
+import threading
+
+import fake_server
+from gpt import GptChat
+from tree import ConversationTree
+from ratelimit import get_limiter
+
+# Drives GptChat with simulated users, each holding its own conversation tree like the app does, and reports
+# throughput, latency percentiles and retries. Without --base-url a fake server is started in the process:
+#
+#   python loadtest.py --users 32 --turns 5 --stream --error-rate 0.05 --rate-limit-rate 0.05
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+class LoadTest:
+    def __init__(self, client: GptChat, users: int, turns: int, max_tokens: int, stream: bool):
+        self.client = client
+        self.users = users
+        self.turns = turns
+        self.max_tokens = max_tokens
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.first_tokens = []
+        self.completion_tokens = 0
+        self.errors = 0
+
+    def run_user(self, user: int):
+        tree = ConversationTree(self.client.system_prompt)
+        for turn in range(self.turns):
+            node = tree.add_message(f'Message {turn} from user {user}', 'user')
+            usage = {}
+            first_token = []
+            on_token = (lambda t: first_token.append(time.perf_counter()) if not first_token else None) if self.stream else None
+            start = time.perf_counter()
+            try:
+                response = self.client.complete(tree.get_context(node), self.max_tokens, on_token,
+                                                prompt_tokens=tree.get_prompt_tokens(node), usage=usage, use_cache=False)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                print(f'User {user} failed: {e}', file=sys.stderr)
+                return
+            end = time.perf_counter()
+            tree.add_response(node, response)
+            with self.lock:
+                self.latencies.append(end - start)
+                if first_token:
+                    self.first_tokens.append(first_token[0] - start)
+                self.completion_tokens += usage.get('completion_tokens', 0)
+
+    def run(self) -> dict:
+        limiter = get_limiter(self.client.model)
+        retries = limiter.retries
+        throttled = limiter.throttled
+        threads = [threading.Thread(target=self.run_user, args=(user,), daemon=True) for user in range(self.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        def ms(value):
+            return None if value is None else round(value * 1000, 1)
+        return {
+            'users': self.users,
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(self.latencies) / elapsed, 2),
+            'tokens_per_second': round(self.completion_tokens / elapsed, 1),
+            'latency_ms': { f'p{p}': ms(percentile(self.latencies, p)) for p in (50, 90, 99) },
+            'first_token_ms': { f'p{p}': ms(percentile(self.first_tokens, p)) for p in (50, 90, 99) } if self.stream else None,
+            'retries': limiter.retries - retries,
+            'throttled': limiter.throttled - throttled,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test GptChat against a fake or real OpenAI compatible server')
+    parser.add_argument('--users', type=int, default=16, help='simulated users, each sends its turns one after the other')
+    parser.add_argument('--turns', type=int, default=5, help='messages sent by every user')
+    parser.add_argument('--max-tokens', type=int, default=100)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--model', default='gpt-4o')
+    parser.add_argument('--system-prompt', default='sys_prompt.txt')
+    parser.add_argument('--base-url', help='server to test, a fake server is started when not given')
+    parser.add_argument('--api-key', default='fake')
+    parser.add_argument('--output', help='file to write the report to as JSON')
+    fake_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    settings = None
+    if base_url is None:
+        settings = fake_server.settings_from_args(args)
+        server = fake_server.start_server(settings)
+        base_url = f'http://127.0.0.1:{server.server_port}/v1'
+
+    client = GptChat(args.system_prompt, args.api_key, base_url)
+    client.change_model(args.model)
+    client.verbose = False
+    report = LoadTest(client, args.users, args.turns, args.max_tokens, args.stream).run()
+    if settings is not None:
+        report['server'] = { 'requests': settings.requests, 'errors': settings.errors, 'rate_limited': settings.rate_limited }
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
+
+if __name__ == '__main__':
+    main()
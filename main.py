@@ -1,122 +1,85 @@
-# TODO: Regeneration should use tree too
-
 import os
 import json
 import datetime
-from uuid import uuid4
+import threading
 from typing import List, Dict
 
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
 
-from key import get_key
-from gpt import GptChat
-
-class MessageNode:
-    def __init__(self, message: str, role: str, parent=None, id=None):
-        self.id = str(uuid4()) if id is None else id
-        self.message = message
-        if role != 'user' and role != 'assistant' and role != 'system':
-            raise Exception(f'Bad role argument for Message node: {role}')
-        self.role = role  # 'user' or 'assistant'
-        self.parent = parent  # Reference to parent MessageNode
-        self.children = []  # List of MessageNode
-        self.selected_child = None  # Currently selected child node
-
-    def add_child(self, node):
-        self.children.append(node)
-        node.parent = self
-        self.selected_child = node
-
-    def select_child(self, index: int):
-        if index < 0 or index > len(self.children):
-            raise Exception(f'Child selection out of range: {index} must be less than {len(self.children)}')
-        self.selected_child = self.children[index]
-        return self.selected_child
-    
-    def selected_child_index(self):
-        if self.selected_child is None:
-            return -1
-        for i in range(len(self.children)):
-            child: MessageNode = self.children[i]
-            if child.id == self.selected_child.id:
-                return i
-        return -1
-
-class ConversationTree:
-    def __init__(self, sys_prompt: str):
-        self.root = MessageNode(sys_prompt, 'system', None)  # Starting MessageNode
-        self.current_node = self.root  # Current position in the conversation
-
-    def add_message(self, message: str, role: str):
-        new_node = MessageNode(message, role, parent=self.current_node)
-        self.current_node.add_child(new_node)
-        self.current_node = new_node
-        return new_node
-
-    def edit_message(self, edit_node: MessageNode, new_message: str):
-        new_node = MessageNode(new_message, 'user', edit_node.parent)
-        parent_node: MessageNode = edit_node.parent
-        parent_node.add_child(new_node)
-        self.current_node = new_node
-        return new_node
-
-    def get_path_from_root(self, node: MessageNode = None):
-        if node is None:
-            node = self.current_node
-        path = []
-        while node:
-            path.insert(0, node)
-            node = node.parent
-        return path
-    
-    def reset_root(self, root_node: MessageNode):
-        self.root = root_node
-        current: MessageNode = self.root.selected_child
-        while True:
-            if current.selected_child is None:
-                break
-            current: MessageNode = current.selected_child
-        self.current_node = current
-
-class ChatApp:
-    root: tk.Tk
-    message_widgets: Dict[str, tk.Frame]
-
-    def __init__(self, root: tk.Tk):
-        self.root = root
-        self.root.title("Simple Chat")
-        self.client = GptChat('sys_prompt.txt', get_key())
+from key import get_key, get_config
+from gpt import GptChat, warm_up
+from chat_view import ChatView
+from tree import MessageNode, ConversationTree, flatten_node, unflatten_nodes, conversation_data, conversation_root
+from tokens import MODEL_CONTEXT_LIMITS, TRIM_POLICIES, count_message_tokens, estimate_message_tokens, trim_messages, get_encoding, encoding_loaded
+from scheduler import Request, RequestScheduler
+from journal import ConversationJournal, apply_events
+from archive import ConversationArchive
+from cache import CompletionCache
+from blobs import BlobStore, make_reference
+from metrics import metrics, RollingStats, JsonlSink, PrometheusSink
+from summaries import Summarizer
+from spill import SpillStore
+
+RESPONSE_TOKENS = 1000  # Room left in the context for the response
+TAB_PRIORITIES = { 'high': 0, 'normal': 1, 'low': 2 }  # Order of the background tabs' requests, the foreground tab goes first
+TABS_FILE = os.path.join('journal', 'tabs.json')  # Journal names of the open tabs, restored on startup
+
+class ConversationTab:
+    # One open conversation: its tree, requests in flight, journal and widgets. The API connections, scheduler, cache,
+    # documents and settings belong to the ChatApp and are shared by every tab.
+    chat_view: ChatView
+    active_requests: Dict[int, Request]
+
+    def __init__(self, app, name: str):
+        self.app = app
+        self.name = name  # Name of the journal files
+        self.title = None  # Shown on the tab, defaults to the first message
+        self.priority = 'normal'
+        self.closed = False
+        self.active_requests = {}  # Requests started from this conversation by id
+        self.request_nodes = {}  # Map request IDs to the node they respond to
+        self.journal = ConversationJournal(name=name)
+        self.archive_id = None  # Archive conversation the open tree was loaded from, its unloaded branches come from there
+        self.frame = tk.Frame(app.notebook)
+        self.new_conversation()
+
+    def new_conversation(self):
+        # Cheap, the system prompt and key are cached and the API client is shared
+        self.client = GptChat('sys_prompt.txt', get_key(), get_config().get('base_url'))
+        self.client.cache = self.app.cache
         self.conversation_tree = ConversationTree(self.client.system_prompt)
-        self.message_widgets = {}  # Map message IDs to their widgets
+        self.conversation_tree.blobs = self.app.blobs
+        # With "memory_budget_mb" in config.json, the text of branches off the selected path goes to disk past the budget
+        budget = get_config().get('memory_budget_mb')
+        if budget:
+            self.conversation_tree.spill = SpillStore(int(budget * 1024 * 1024))
         self.build_gui()
-        self.root.protocol("WM_DELETE_WINDOW", self.on_quit)
+
+    def recover_session(self):
+        # Restore the conversation that was open in this tab when the app was last closed or crashed
+        recovered = self.journal.recover()
+        if recovered is not None:
+            snapshot, events = recovered
+            self.load_snapshot(snapshot)
+            state = apply_events(self.conversation_tree, events)
+            self.client.change_model(state.get('model', self.client.model))
+            self.client.total_tokens = state.get('total_tokens', self.client.total_tokens)
+            self.display_from_node(self.conversation_tree.root.selected_child)
+        self.journal.attach(self.conversation_tree, self.session_snapshot)
 
     def build_gui(self):
-        # Main frame
-        self.main_frame = tk.Frame(self.root)
-        self.main_frame.pack(expand=True, fill='both')
+        for widget in self.frame.winfo_children():
+            widget.destroy()
 
-        self.message_frame = tk.Frame(self.main_frame)
+        self.message_frame = tk.Frame(self.frame)
         self.message_frame.pack(expand=True, fill='both')
 
-        # Canvas for scrolling
-        self.canvas = tk.Canvas(self.message_frame)
-        self.canvas.pack(side='left', fill='both', expand=True)
-
-        # Scrollbar for canvas
-        self.scrollbar = tk.Scrollbar(self.message_frame, orient='vertical', command=self.canvas.yview)
-        self.scrollbar.pack(side='right', fill='y')
-
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
-        self.canvas.bind('<Configure>', lambda e: self.canvas.configure(scrollregion=self.canvas.bbox('all')))
-
-        # Frame inside the canvas
-        self.chat_frame = tk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.chat_frame, anchor='nw')
+        # Scrollable message list, only the boxes near the viewport exist as widgets
+        self.chat_view = ChatView(self.message_frame, self.edit_message, self.select_branch, self.app.blobs.preview)
 
         # Input area
-        self.input_frame = tk.Frame(self.main_frame)
+        self.input_frame = tk.Frame(self.frame)
         self.input_frame.pack(fill='x')
 
         self.input_text = tk.Text(self.input_frame, height=3)
@@ -129,38 +92,20 @@ class ChatApp:
 
         # Bind Enter and Shift+Enter
         self.input_text.bind('<Return>', self.on_enter_pressed)
-
-        # Status bar
-        self.status_bar = tk.Label(self.main_frame, text="", bd=1, relief=tk.SUNKEN, anchor=tk.W)
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
-
-        # Menu bar
-        self.menu_bar = tk.Menu(self.root)
-        self.build_menu()
-        self.root.config(menu=self.menu_bar)
-
-    def build_menu(self):
-        # File menu
-        file_menu = tk.Menu(self.menu_bar, tearoff=0)
-        file_menu.add_command(label="Save", command=lambda: self.run_command("save"))
-        file_menu.add_command(label="Load", command=lambda: self.run_command("load"))
-        file_menu.add_separator()
-        file_menu.add_command(label="Reset", command=lambda: self.run_command("reset"))
-        file_menu.add_separator()
-        file_menu.add_command(label="Quit", command=self.on_quit)
-        self.menu_bar.add_cascade(label="File", menu=file_menu)
-
-        # Options menu
-        options_menu = tk.Menu(self.menu_bar, tearoff=0)
-        options_menu.add_command(label="Change Model", command=lambda: self.run_command("change_model"))
-        options_menu.add_command(label="Include File", command=self.include)
-        options_menu.add_command(label="Regenerate", command=lambda: self.run_command("regen"))
-        self.menu_bar.add_cascade(label="Options", menu=options_menu)
-
-        # Help menu
-        help_menu_bar = tk.Menu(self.menu_bar, tearoff=0)
-        help_menu_bar.add_command(label="Help", command=lambda: self.run_command("help"))
-        self.menu_bar.add_cascade(label="Help", menu=help_menu_bar)
+        # Keep the prompt size in the status bar up to date while typing
+        self.input_text.bind('<KeyRelease>', lambda e: self.app.schedule_status_update())
+        # The text widget has its own Ctrl+T, the tab shortcuts win
+        self.input_text.bind('<Control-t>', lambda e: self.app.run_command('new') or 'break')
+        self.input_text.bind('<Control-w>', lambda e: self.app.run_command('close') or 'break')
+
+    def label(self) -> str:
+        title = self.title
+        if title is None:
+            first = self.conversation_tree.root.selected_child
+            title = ' '.join(first.message.split())[:20] if first is not None else 'New Conversation'
+        if self.active_requests:
+            title += f' ({len(self.active_requests)})'
+        return title
 
     def get_and_reset_user_input(self):
         user_input = self.input_text.get("1.0", tk.END).strip()
@@ -171,62 +116,37 @@ class ChatApp:
 
     def send_message(self):
         user_input = self.get_and_reset_user_input()
+        if user_input is None:
+            return
         if user_input.startswith('\\'):
-            self.run_command(user_input[1:])
+            self.app.run_command(user_input[1:])
+        elif self.awaiting_response(self.conversation_tree.current_node):
+            self.input_text.insert('1.0', user_input)
+            messagebox.showwarning("Busy", "Still waiting for a response on this branch, cancel it or switch branches first.")
         else:
+            # Responses still streaming in for other branches give up their boxes, the new message goes right below
+            self.remove_messages_after(self.conversation_tree.current_node)
             user_node = self.conversation_tree.add_message(user_input, 'user')  # Add to conversation tree first
             self.add_message_box(user_node)
             self.get_response(user_node)
 
     def add_message_box(self, node: MessageNode):
-        # If the message already has a widget, don't create it again
-        if node.id in self.message_widgets:
-            return
-
-        frame = tk.Frame(self.chat_frame, bd=2, relief='groove', padx=5, pady=5)
-        frame.pack(fill='x', padx=5, pady=5)
-
-        message_label = tk.Text(frame, wrap='word', height=4, bg='#f0f0f0' if node.role == 'assistant' else '#e0ffe0')
-        message_label.insert('1.0', node.message)
-        message_label.config(state='disabled')
-        message_label.pack(side='left', fill='both', expand=True)
-
-        # Calculate the number of lines
-        num_lines = node.message.count("\n")
-        box_width = 90
-        
-        # Calculate the total word wraps
-        total_word_wraps = 0
-        for num_wraps in [len(line) // box_width for line in node.message.split('\n')]:
-            total_word_wraps += num_wraps
-        
-        # Set the dimensions of the text widget
-        message_label.config(width=box_width, height=num_lines+total_word_wraps)
-
-        controls_frame = tk.Frame(frame)
-        controls_frame.pack(side='right', fill='y')
-
-        if node.role == 'user':
-            edit_button = tk.Button(controls_frame, text='Edit', command=lambda n=node: self.edit_message(n))
-            edit_button.pack(side='top')
+        # If the message already has a box, don't create it again
+        self.chat_view.append(node)
 
-        parent: MessageNode = node.parent
-        children: List[MessageNode] = parent.children
+    def refresh_message_box(self, node: MessageNode):
+        # Redraw the box of a displayed message in place
+        self.chat_view.refresh(node)
 
-        if len(children) > 1:
-            # If multiple branches exist, provide a dropdown to select
-            branch_options = [f"Branch {i+1}" for i in range(len(children))]
-            selected_branch = tk.StringVar()
-            selected_branch.set(branch_options[parent.selected_child_index()])
+    def add_pending_box(self, request: Request, node: MessageNode):
+        # Placeholder box that the assistant response is streamed into before its node exists
+        self.chat_view.add_pending(request.id, node)
 
-            branch_menu = ttk.Combobox(controls_frame, textvariable=selected_branch, values=branch_options, state='readonly')
-            branch_menu.pack(side='top')
-            branch_menu.bind('<<ComboboxSelected>>', lambda event, n=node, sv=selected_branch: self.select_branch(n, sv.get()))
+    def remove_pending_box(self, request_id: int):
+        self.chat_view.remove_pending(request_id)
 
-        self.message_widgets[node.id] = frame
-        self.root.update_idletasks()
-        self.canvas.configure(scrollregion=self.canvas.bbox('all'))
-        self.canvas.yview_moveto(1)
+    def append_pending_text(self, request: Request, text: str):
+        self.chat_view.append_pending(request.id, text)
 
     def select_branch(self, node: MessageNode, branch_label: str):
         branch_index = int(branch_label.split(' ')[1]) - 1
@@ -235,18 +155,20 @@ class ChatApp:
         if 0 <= branch_index < len(children):
             # Remove existing message boxes after this node
             self.remove_messages_after(parent)
-            selected_node = parent.select_child(branch_index)
+            selected_node = self.conversation_tree.select_branch(parent, branch_index)
             # Display the selected branch
             self.display_from_node(selected_node)
         else:
             messagebox.showerror("Error", "Invalid branch selected.")
 
     def display_from_node(self, node: MessageNode):
-        # Display messages starting from the given node
+        # Display messages starting from the given node, laid out in one batch
+        nodes = []
         current = node
         while current:
-            self.add_message_box(current)
+            nodes.append(current)
             current = current.selected_child
+        self.chat_view.extend(nodes)
 
     def edit_message(self, node: MessageNode):
         # Prompt user to edit the message
@@ -262,74 +184,110 @@ class ChatApp:
         self.get_response(edited_node)
 
     def remove_messages_after(self, node: MessageNode):
-        # Remove all message boxes after the given node
-        nodes_to_remove: List[MessageNode] = []
-        current: MessageNode = node.selected_child
-        while current:
-            nodes_to_remove.append(current)
-            current: MessageNode = current.selected_child
-
-        for n in nodes_to_remove:
-            frame = self.message_widgets[n.id]
-            if frame:
-                frame.destroy()
-                del self.message_widgets[n.id]
-
-    def get_response(self, node):
-        # Build the message path up to the current node
-        path = self.conversation_tree.get_path_from_root(node)
-        self.client.reset_chat()
-        for node in path[:-1]:
-            self.client.add_message(node.role, node.message)
-        # Send the messages to the client
-        response = self.client.send(path[-1].message)
-        # Add assistant's response to the conversation tree
-        assistant_node = self.conversation_tree.add_message(response, 'assistant')
-        self.root.after(0, self.add_message_box, assistant_node)
-        self.root.after(0, self.update_status)
-
-    def update_status(self):
-        self.status_bar.config(text=f"Usage: {self.client.total_tokens} tokens, Model: {self.client.model}")
-
-    def run_command(self, cmd: str):
-        parts = cmd.strip().split(' ')
-        command = parts[0]
-        args = parts[1:]
-        if command == 'help':
-            self.help_menu()
-        elif command == 'save':
-            self.save_conversation(args)
-        elif command == 'reset':
-            self.reset_app()
-        elif command == 'load':
-            self.load_menu()
-        elif command == 'change_model':
-            self.model_menu()
-        elif command == 'include':
-            self.include(args[0] if args else None)
-        elif command == 'regen':
-            self.regen_message()
-        elif command == 'quit':
-            self.on_quit()
-        else:
-            messagebox.showerror("Error", f"Unknown command: {cmd}")
-
-    def help_menu(self):
-        help_text = '''
-HELP MENU:
-save [file_name]: saves the conversation tree to "completions/[file_name]_[today].json" and resets the app
-load: go to load menu (app will be reset)
-reset: reset conversation (app will be reset)
-change_model: change current model
-include [file_name]: include file data in the current context
-regen: rerun last message again
-'''
-        messagebox.showinfo("Help", help_text)
+        # Remove all message boxes after the given node, responses still streaming in there are no longer shown
+        self.chat_view.truncate_after(node)
+
+    def get_response(self, node: MessageNode, use_cache: bool = True, model: str = None):
+        app = self.app
+        # model defaults to the one picked in the model menu
+        model = model or self.client.model
+        # Messages on the path up to the node, cached on the tree
+        tree = self.conversation_tree
+        messages = tree.get_context(node)
+        prompt_tokens = tree.get_prompt_tokens(node)
+        budget = self.client.context_limit(model) - RESPONSE_TOKENS
+        summarize = app.summarize_turns.get() and app.summarizer.split(len(messages)) > 0
+        path = None
+        if summarize:
+            # The older messages are replaced by their summary on the worker thread, where the size is counted again
+            path = tree.get_path_from_root(node)
+            prompt_tokens = app.summarizer.estimate_tokens(tree.get_token_counts(node), messages)
+        if prompt_tokens > budget:
+            if summarize:
+                messagebox.showerror("Error", f"The prompt is about {prompt_tokens} tokens even with older turns summarized, {model} allows {budget}.")
+                return
+            if app.trim_policy.get() == 'error':
+                messagebox.showerror("Error", f"The prompt is {prompt_tokens} tokens, {model} allows {budget}.\nEdit an earlier message or allow dropping the oldest messages in Options > Context Overflow.")
+                return
+            messages, prompt_tokens = trim_messages(messages, tree.get_token_counts(node), budget)
+        stream = app.stream_responses.get()
+        # Regenerated responses always bypass the cache, the point is to sample a new one
+        use_cache = use_cache and app.use_cache.get()
+
+        # The request runs on a worker thread, the callbacks run back on the Tk thread
+        def work(request: Request):
+            on_token = (lambda t: app.scheduler.emit_token(request, t)) if stream else None
+            payload = messages
+            if summarize:
+                payload = app.summarizer.compact(self.client, tree, path, messages, request.cancel_event, model)
+            # Documents are only read back into the messages for the payload itself
+            payload = app.blobs.expand_messages(payload)
+            return self.client.complete(payload, RESPONSE_TOKENS, on_token, request.cancel_event, None if summarize else prompt_tokens,
+                                        usage=request.usage, use_cache=use_cache, stats=request.stats, model=model)
+
+        request = app.scheduler.submit(
+            work,
+            label=f'{model} reply',
+            on_token=lambda t: self.append_pending_text(request, t),
+            on_done=lambda response: self.on_response(request, response, model),
+            on_error=lambda e: self.on_request_error(request, e),
+            on_cancel=lambda: self.finish_request(request),
+            priority=app.request_priority(self)
+        )
+        self.active_requests[request.id] = request
+        self.request_nodes[request.id] = node
+        if stream:
+            # Show the response as it is generated, the node is only added once it is complete
+            self.add_pending_box(request, node)
+        app.update_status()
+
+    def on_response(self, request: Request, response: str, model: str):
+        node = self.request_nodes[request.id]
+        # Add assistant's response to the conversation tree, tagged with where it came from
+        info = {
+            'model': model,
+            'latency': round(request.finished - request.started, 2),
+            'usage': dict(request.usage),
+            'time': round(request.finished, 3),
+        }
+        if request.stats.get('cache_hit'):
+            info['cached'] = True
+        assistant_node = self.conversation_tree.add_response(node, response, info)
+        shown = self.conversation_tree.current_node is assistant_node
+        self.finish_request(request, assistant_node if shown else None)
+        self.journal.record('usage', total_tokens=self.client.total_tokens)
+        if shown:
+            self.add_message_box(assistant_node)
+        elif node.selected_child is not None and self.chat_view.contains(node.selected_child):
+            # A sibling of the displayed message arrived, redraw it so its branch menu lists the new branch
+            self.refresh_message_box(node.selected_child)
+
+    def on_request_error(self, request: Request, e: Exception):
+        self.finish_request(request)
+        where = '' if self.app.tab is self else f' in {self.label()}'
+        messagebox.showerror("Error", f"Request failed{where}\n{e}")
+
+    def finish_request(self, request: Request, response_node: MessageNode = None):
+        self.active_requests.pop(request.id, None)
+        self.request_nodes.pop(request.id, None)
+        # Requests of a closed tab are cancelled, their widgets are already gone
+        if not self.closed:
+            # A displayed response goes where its box was, not after the boxes of requests that are still streaming
+            if response_node is None or not self.chat_view.replace_pending(request.id, response_node):
+                self.remove_pending_box(request.id)
+
+    def awaiting_response(self, node: MessageNode):
+        return any(n is node for n in self.request_nodes.values())
+
+    def cancel_requests(self):
+        for request in list(self.active_requests.values()):
+            self.app.scheduler.cancel(request)
+        self.app.update_status()
 
     def ask_save(self):
         if len(self.conversation_tree.root.children) == 0:
             return
-        if messagebox.askyesno("Save", "Conversation not empty, save current conversation?"):
+        if messagebox.askyesno("Save", f"Conversation {self.label()} not empty, save it?"):
             file_name = simpledialog.askstring("Save", "File Name:")
             if file_name:
                 self.save_conversation([file_name])
@@ -345,42 +303,67 @@ regen: rerun last message again
             os.makedirs('completions')
         today = datetime.date.today().strftime("%Y-%m-%d")
         full_name = f'completions/{file_name}_{today}.json'
-        # Serialize the conversation tree
-        data = self.serialize_conversation_tree()
-        with open(full_name, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4)
+        # Written next to the file and moved into place, a failed save leaves an earlier one with the same name intact
+        tmp_file = full_name + '.tmp'
+        try:
+            data = self.serialize_conversation_tree()
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp_file, full_name)
+        except Exception as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            messagebox.showerror("Error", f"Could not save the conversation to {full_name}\n{e}")
+            return
+        try:
+            # Keep the search index up to date, the archive copy replaces any earlier save to the same file
+            self.app.get_archive().import_file(full_name)
+        except Exception as e:
+            print(f'Could not add {full_name} to the archive\n{e}')
         messagebox.showinfo("Save", f"Conversation saved to {full_name}")
-        self.reset_app(False)
+        self.reset(False)
 
     def serialize_conversation_tree(self):
         # Serialize the conversation tree into a JSON-serializable format
-        def serialize_node(node):
-            data = {
-                'id': node.id,
-                'message': node.message,
-                'role': node.role,
-                'children': [serialize_node(child) for child in node.children],
-                'selected_child_id': node.selected_child.id if node.selected_child else None,
-            }
-            return data
-        root_node = self.conversation_tree.root
+        return conversation_data(self.conversation_tree.root, self.client.model, self.client.total_tokens)
+
+    def session_snapshot(self):
+        # Written by the journal. Flat so it has no depth limit, and branches that were never loaded from the
+        # archive are left out and read from there again on recovery.
         return {
             'model': self.client.model,
             'total_tokens': self.client.total_tokens,
-            'conversation_tree': serialize_node(root_node) if root_node else None,
+            'archive_id': self.archive_id,
+            'title': self.title,
+            'priority': self.priority,
+            'nodes': flatten_node(self.conversation_tree.root, expand=False),
         }
 
-    def reset_app(self, ask_save: bool = False):
+    def load_snapshot(self, snapshot):
+        loader = None
+        if snapshot.get('archive_id') is not None:
+            self.archive_id = snapshot['archive_id']
+            loader = self.app.get_archive().make_loader(self.archive_id)
+        self.title = snapshot.get('title')
+        self.priority = snapshot.get('priority', self.priority)
+        self.client.change_model(snapshot.get('model', self.client.model))
+        self.client.total_tokens = snapshot.get('total_tokens', 0)
+        self.conversation_tree.reset_root(unflatten_nodes(snapshot['nodes'], loader))
+
+    def reset(self, ask_save: bool = False):
         if ask_save:
             self.ask_save()
-        self.main_frame.destroy()
-        self.client = GptChat('sys_prompt.txt', get_key())
-        self.conversation_tree = ConversationTree(self.client.system_prompt)
-        self.message_widgets = {}
-        self.build_gui()
-        self.update_status()
-
-    def include(self, file_name: str = None):
+        self.archive_id = None
+        self.title = None
+        # Requests for the old conversation have nowhere to go anymore
+        self.cancel_requests()
+        self.active_requests = {}
+        self.request_nodes = {}
+        self.new_conversation()
+        self.journal.attach(self.conversation_tree, self.session_snapshot)
+        self.app.update_status()
+
+    def include(self, file_name: str = None, excerpts: bool = False):
         if file_name is None:
             file_name = filedialog.askopenfilename(initialdir='data', title="Select file to include",
                                                    filetypes=(("Text files", "*.txt"), ("All files", "*.*")))
@@ -390,14 +373,25 @@ regen: rerun last message again
         if not os.path.exists(full_name):
             messagebox.showerror("Error", f"File {full_name} does not exist")
             return
-        with open(full_name, 'r', encoding='utf-8') as f:
-            text = f.read()
-        user_node = self.conversation_tree.add_message(f'Here is a document that I want to include in our conversation:\n{text}', 'user')
+        # The document is stored once in the blob store, the message only holds a reference to it
+        try:
+            digest = self.app.blobs.put_file(full_name)
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not include file {full_name}\n{e}")
+            return
+        if excerpts:
+            # Only the chunks that best match each new message are sent, so the prompt stays small for any file size
+            reference = make_reference(digest, os.path.basename(full_name), 'excerpts')
+            message = f'Here are the parts of a document that are relevant to my latest message:\n{reference}'
+        else:
+            reference = make_reference(digest, os.path.basename(full_name))
+            message = f'Here is a document that I want to include in our conversation:\n{reference}'
+        user_node = self.conversation_tree.add_message(message, 'user')
         self.add_message_box(user_node)
         assistant_node = self.conversation_tree.add_message('Ok', 'assistant')
         self.add_message_box(assistant_node)
 
-    def load_file(self, full_name: str):
+    def load_file(self, full_name: str, path_ids: List[str] = None):
         if not os.path.exists(full_name):
             messagebox.showerror("Error", f"Could not find file {full_name}")
             return
@@ -407,27 +401,34 @@ regen: rerun last message again
             except Exception as e:
                 messagebox.showerror("Error", f"Could not load file {full_name}\n{e}")
                 return
-        self.reset_app()
+        self.reset()
+        self.load_data(data)
+        self.title = os.path.splitext(os.path.basename(full_name))[0]
+        self.select_path(path_ids)
+        self.journal.attach(self.conversation_tree, self.session_snapshot)
+        self.display_from_node(self.conversation_tree.root.selected_child)
+        self.app.update_status()
+
+    def select_path(self, path_ids: List[str] = None):
+        # Open the loaded conversation at a message, e.g. a search result
+        if not path_ids:
+            return
+        try:
+            self.conversation_tree.select_path(path_ids)
+        except Exception as e:
+            messagebox.showwarning("Search", f"Could not find the message, the conversation may have changed since it was indexed\n{e}")
+
+    def load_data(self, data):
         self.client.change_model(data.get('model', self.client.model))
         self.client.total_tokens = data.get('total_tokens', 0)
-        self.deserialize_conversation_tree(data.get('conversation_tree'))
-        self.display_from_node(self.conversation_tree.root.selected_child)
-        self.update_status()
+        self.deserialize_conversation_tree(data)
 
     def deserialize_conversation_tree(self, data):
-        if not data:
+        # Reconstruct the conversation tree from the serialized data, files saved before the flat format included
+        root = conversation_root(data)
+        if root is None:
             return
-        
-        # Reconstruct the conversation tree from the serialized data
-        def deserialize_node(data, parent=None):
-            node = MessageNode(data['message'], data['role'], parent=parent, id=data['id'])
-            # Deserialize children
-            for child_data in data.get('children', []):
-                child_node = deserialize_node(child_data, parent=node)
-                node.add_child(child_node)
-            return node
-
-        self.conversation_tree.reset_root(deserialize_node(data))
+        self.conversation_tree.reset_root(root)
 
     def load_menu(self):
         self.ask_save()
@@ -439,37 +440,58 @@ regen: rerun last message again
         if file_name:
             self.load_file(file_name)
 
-    def model_menu(self):
-        models = [
-            'gpt-4o',
-            'gpt-4o-mini',
-            'o1-preview',
-            'o1-mini'
-        ]
-        def set_model(model):
-            self.client.change_model(model)
-            messagebox.showinfo("Model Changed", f"Model changed to {model}")
-            self.update_status()
-            model_window.destroy()
-        model_window = tk.Toplevel(self.root)
-        model_window.title("Select Model")
-        tk.Label(model_window, text="Select a model:").pack()
-        for model in models:
-            tk.Button(model_window, text=model, command=lambda m=model: set_model(m)).pack(fill='x')
-        tk.Button(model_window, text="Cancel", command=model_window.destroy).pack(fill='x')
+    def save_to_archive(self, args):
+        if args:
+            name = args[0]
+        else:
+            name = simpledialog.askstring("Save to Archive", "Name:")
+            if not name:
+                return
+        self.app.get_archive().save(name, self.conversation_tree.root, self.client.model, self.client.total_tokens)
+        messagebox.showinfo("Save", f"Conversation saved to the archive as {name}")
+        self.reset(False)
+
+    def open_from_archive(self, conversation_id: int, path_ids: List[str] = None):
+        info, root = self.app.get_archive().load(conversation_id)
+        self.reset()
+        self.client.change_model(info['model'] or self.client.model)
+        self.client.total_tokens = info['total_tokens'] or 0
+        self.conversation_tree.reset_root(root)
+        self.archive_id = conversation_id
+        self.title = info['name']
+        self.select_path(path_ids)
+        self.journal.attach(self.conversation_tree, self.session_snapshot)
+        self.display_from_node(self.conversation_tree.root.selected_child)
+        self.app.update_status()
 
-    def regen_message(self):
+    def regen_message(self, count: int = 1):
         if self.conversation_tree.current_node and self.conversation_tree.current_node.role == 'assistant':
             # Remove the assistant's last message and regenerate
             parent_node = self.conversation_tree.current_node.parent
             self.remove_messages_after(parent_node)
+            self.conversation_tree.remove_child(parent_node, self.conversation_tree.current_node)
             self.conversation_tree.current_node = parent_node
-            self.conversation_tree.current_node.children.remove(self.conversation_tree.current_node.selected_child)
-            self.conversation_tree.current_node.selected_child = None
-            self.get_response(self.conversation_tree.current_node)
+            # Every response is its own request, they run side by side and each lands as a branch of the user message
+            for _ in range(count):
+                self.get_response(self.conversation_tree.current_node, use_cache=False)
         else:
             messagebox.showerror("Error", "No assistant message to regenerate.")
 
+    def compare_models(self, models: List[str]):
+        # The path up to the last user message goes to every model at once, so the comparison takes as long as the
+        # slowest model. Each response becomes a branch of the user message, tagged with its model.
+        node = self.conversation_tree.current_node
+        if node.role == 'assistant':
+            node = node.parent
+        if node.role != 'user':
+            messagebox.showerror("Error", "No user message to compare responses for.")
+            return
+        if node is not self.conversation_tree.current_node:
+            self.remove_messages_after(node)
+            self.conversation_tree.current_node = node
+        for model in models:
+            self.get_response(node, model=model)
+
     # Handle Enter and Shift+Enter in input_text
     def on_enter_pressed(self, event):
         if (event.state & 0x0001) == 0x0001:
@@ -481,7 +503,507 @@ regen: rerun last message again
             self.send_message()
             return 'break'
 
+    def close(self):
+        # Cancelled requests still report back, finish_request leaves the destroyed widgets alone
+        self.closed = True
+        self.cancel_requests()
+        self.journal.remove()
+        self.frame.destroy()
+
+class ChatApp:
+    # The workspace: one tab per open conversation. Every tab sends its requests through the same scheduler and
+    # API connections, queued requests of the foreground tab are picked up first.
+    root: tk.Tk
+    tabs: List[ConversationTab]
+
+    def __init__(self, root: tk.Tk):
+        self.root = root
+        self.root.title("Simple Chat")
+        # tiktoken is loaded off the Tk thread, the status bar estimates the prompt size until it is there
+        threading.Thread(target=get_encoding, daemon=True).start()
+        self.cache = CompletionCache()  # Shared by every conversation, survives resets
+        self.blobs = BlobStore()  # Included documents, messages only reference them
+        self.stream_responses = tk.BooleanVar(value=True)
+        self.use_cache = tk.BooleanVar(value=True)
+        self.show_metrics = tk.BooleanVar(value=False)
+        self.summarize_turns = tk.BooleanVar(value=False)  # Send older turns of long branches as a summary
+        self.summarizer = Summarizer(self.blobs)
+        self.tab_priority = tk.StringVar(value='normal')  # Priority of the foreground tab, as shown in the menu
+        self.rolling_stats = None  # Metrics sink behind the status bar summary
+        self.setup_metrics()
+        self.trim_policy = tk.StringVar(value='error')  # What to do when the prompt does not fit the model's context
+        self.status_job = None
+        self.scheduler = RequestScheduler()
+        self.archive = None  # Opened on first use
+        self.tabs = []
+        self.tab: ConversationTab = None  # The foreground tab
+        self.build_gui()
+        self.recover_session()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_quit)
+        self.root.bind('<Escape>', lambda e: self.tab.cancel_requests())
+        self.root.bind('<Control-t>', lambda e: self.run_command('new'))
+        self.root.bind('<Control-w>', lambda e: self.run_command('close'))
+        self.poll_scheduler()
+        if get_config().get('warm_up', False):
+            # Once the window is up, connect to the API in the background so the first message does not wait for it
+            self.root.after_idle(lambda: threading.Thread(target=warm_up, args=(get_key(), get_config().get('base_url')), daemon=True).start())
+
+    def recover_session(self):
+        # Reopen the tabs that were open when the app was last closed or crashed, each from its own journal
+        names, selected = ['session'], 0
+        if os.path.exists(TABS_FILE):
+            try:
+                with open(TABS_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                names, selected = data['tabs'] or names, data.get('selected', 0)
+            except Exception as e:
+                print(f'Could not read {TABS_FILE}\n{e}')
+        for name in names:
+            self.new_tab(name)
+        self.select_tab(self.tabs[min(selected, len(self.tabs) - 1)])
+
+    def save_tabs(self):
+        if not os.path.exists('journal'):
+            os.makedirs('journal')
+        tmp_file = TABS_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({ 'tabs': [tab.name for tab in self.tabs], 'selected': self.tabs.index(self.tab) if self.tab in self.tabs else 0 }, f)
+        os.replace(tmp_file, TABS_FILE)
+
+    def new_tab(self, name: str = None) -> ConversationTab:
+        if name is None:
+            names = { tab.name for tab in self.tabs }
+            number = 2
+            while f'session-{number}' in names:
+                number += 1
+            name = f'session-{number}'
+        tab = ConversationTab(self, name)
+        self.tabs.append(tab)
+        self.notebook.add(tab.frame, text=tab.label())
+        tab.recover_session()
+        if self.tab is None:
+            self.tab = tab
+        return tab
+
+    def select_tab(self, tab: ConversationTab):
+        self.notebook.select(tab.frame)
+        self.on_tab_changed()
+
+    def close_tab(self, tab: ConversationTab):
+        if len(self.tabs) == 1:
+            tab.reset(True)
+            return
+        tab.ask_save()
+        index = self.tabs.index(tab)
+        self.tabs.remove(tab)
+        tab.close()
+        if self.tab is tab:
+            self.tab = None
+            self.select_tab(self.tabs[min(index, len(self.tabs) - 1)])
+        else:
+            self.save_tabs()
+
+    def on_tab_changed(self, event=None):
+        selected = self.notebook.select()
+        tab = next((tab for tab in self.tabs if str(tab.frame) == selected), None)
+        if tab is None or tab is self.tab and event is not None:
+            return
+        self.tab = tab
+        self.tab_priority.set(tab.priority)
+        self.update_priorities()
+        self.save_tabs()
+        tab.input_text.focus_set()
+        self.update_status()
+
+    def request_priority(self, tab: ConversationTab) -> int:
+        # Lower goes first: the foreground tab, then the background tabs by their own priority
+        if tab is self.tab:
+            return 0
+        return 1 + TAB_PRIORITIES[tab.priority]
+
+    def update_priorities(self):
+        # Queued requests follow their tab to the front or back, running ones carry on either way
+        for tab in self.tabs:
+            priority = self.request_priority(tab)
+            for request in tab.active_requests.values():
+                self.scheduler.set_priority(request, priority)
+
+    def set_tab_priority(self, priority: str):
+        self.tab.priority = priority
+        self.tab_priority.set(priority)
+        self.tab.journal.compact()
+        self.update_priorities()
+
+    def setup_metrics(self):
+        # Sinks are configured under "metrics" in config.json, e.g. { "status_bar": true, "file": "metrics.jsonl",
+        # "prometheus_port": 9464 }. Without any the timing hooks cost next to nothing.
+        config = get_config().get('metrics', {})
+        if config.get('status_bar'):
+            self.show_metrics.set(True)
+            self.toggle_metrics()
+        if config.get('file'):
+            metrics.add_sink(JsonlSink(config['file'], config.get('timings', False)))
+        if config.get('prometheus_port'):
+            try:
+                metrics.add_sink(PrometheusSink(config['prometheus_port']))
+            except OSError as e:
+                print(f"Could not serve metrics on port {config['prometheus_port']}\n{e}")
+
+    def toggle_metrics(self):
+        if self.show_metrics.get() and self.rolling_stats is None:
+            self.rolling_stats = metrics.add_sink(RollingStats())
+        elif not self.show_metrics.get() and self.rolling_stats is not None:
+            metrics.remove_sink(self.rolling_stats)
+            self.rolling_stats = None
+        if hasattr(self, 'status_bar'):
+            self.update_status()
+
+    def build_gui(self):
+        # Main frame
+        self.main_frame = tk.Frame(self.root)
+        self.main_frame.pack(expand=True, fill='both')
+
+        # One page per conversation, Ctrl+Tab switches between them
+        self.notebook = ttk.Notebook(self.main_frame)
+        self.notebook.pack(expand=True, fill='both')
+        self.notebook.enable_traversal()
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+
+        # Status bar
+        self.status_bar = tk.Label(self.main_frame, text="", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+
+        # Menu bar
+        self.menu_bar = tk.Menu(self.root)
+        self.build_menu()
+        self.root.config(menu=self.menu_bar)
+
+    def build_menu(self):
+        # File menu
+        file_menu = tk.Menu(self.menu_bar, tearoff=0)
+        file_menu.add_command(label="New Tab", command=lambda: self.run_command("new"), accelerator="Ctrl+T")
+        file_menu.add_command(label="Close Tab", command=lambda: self.run_command("close"), accelerator="Ctrl+W")
+        file_menu.add_separator()
+        file_menu.add_command(label="Save", command=lambda: self.run_command("save"))
+        file_menu.add_command(label="Load", command=lambda: self.run_command("load"))
+        file_menu.add_separator()
+        file_menu.add_command(label="Save to Archive", command=lambda: self.run_command("archive"))
+        file_menu.add_command(label="Open from Archive", command=lambda: self.run_command("open"))
+        file_menu.add_command(label="Import Completions", command=lambda: self.run_command("import"))
+        file_menu.add_command(label="Search", command=lambda: self.run_command("search"))
+        file_menu.add_separator()
+        file_menu.add_command(label="Reset", command=lambda: self.run_command("reset"))
+        file_menu.add_separator()
+        file_menu.add_command(label="Quit", command=self.on_quit)
+        self.menu_bar.add_cascade(label="File", menu=file_menu)
+
+        # Options menu
+        options_menu = tk.Menu(self.menu_bar, tearoff=0)
+        options_menu.add_command(label="Change Model", command=lambda: self.run_command("change_model"))
+        options_menu.add_command(label="Include File", command=lambda: self.tab.include())
+        options_menu.add_command(label="Include File Excerpts", command=lambda: self.tab.include(excerpts=True))
+        options_menu.add_command(label="Regenerate", command=lambda: self.run_command("regen"))
+        options_menu.add_command(label="Regenerate Several", command=self.regen_menu)
+        options_menu.add_command(label="Compare Models", command=lambda: self.run_command("compare"))
+        options_menu.add_command(label="Cancel Generation", command=lambda: self.run_command("cancel"))
+        options_menu.add_separator()
+        options_menu.add_checkbutton(label="Stream Responses", variable=self.stream_responses)
+        options_menu.add_checkbutton(label="Use Response Cache", variable=self.use_cache)
+        options_menu.add_checkbutton(label="Summarize Older Turns", variable=self.summarize_turns)
+        options_menu.add_checkbutton(label="Show Metrics", variable=self.show_metrics, command=self.toggle_metrics)
+        trim_menu = tk.Menu(options_menu, tearoff=0)
+        trim_menu.add_radiobutton(label="Show Error", variable=self.trim_policy, value='error')
+        trim_menu.add_radiobutton(label="Drop Oldest Messages", variable=self.trim_policy, value='drop_oldest')
+        options_menu.add_cascade(label="Context Overflow", menu=trim_menu)
+        priority_menu = tk.Menu(options_menu, tearoff=0)
+        for priority in TAB_PRIORITIES:
+            priority_menu.add_radiobutton(label=priority.capitalize(), variable=self.tab_priority, value=priority,
+                                          command=lambda p=priority: self.set_tab_priority(p))
+        options_menu.add_cascade(label="Tab Priority", menu=priority_menu)
+        self.menu_bar.add_cascade(label="Options", menu=options_menu)
+
+        # Help menu
+        help_menu_bar = tk.Menu(self.menu_bar, tearoff=0)
+        help_menu_bar.add_command(label="Help", command=lambda: self.run_command("help"))
+        self.menu_bar.add_cascade(label="Help", menu=help_menu_bar)
+
+    def poll_scheduler(self):
+        # Hand finished work and streamed chunks from the worker threads back to the Tk thread
+        if self.scheduler.process_callbacks():
+            self.update_status()
+        self.root.after(30, self.poll_scheduler)
+
+    def schedule_status_update(self):
+        if self.status_job is not None:
+            self.root.after_cancel(self.status_job)
+        self.status_job = self.root.after(250, self.update_status)
+
+    def update_status(self):
+        self.status_job = None
+        tab = self.tab
+        if tab is None:
+            return
+        # Size of the prompt that would be sent if the input was sent now
+        exact = encoding_loaded()
+        count = count_message_tokens if exact else estimate_message_tokens
+        prompt_tokens = tab.conversation_tree.get_prompt_tokens() if exact else tab.conversation_tree.estimate_prompt_tokens()
+        user_input = tab.input_text.get("1.0", tk.END).strip()
+        if user_input and not user_input.startswith('\\'):
+            prompt_tokens += count(user_input)
+        if not exact:
+            # Shown as an estimate until the encoding is loaded, then counted
+            self.schedule_status_update()
+        status = f"Usage: {tab.client.total_tokens} tokens, Model: {tab.client.model}, Prompt: {'' if exact else '~'}{prompt_tokens}/{tab.client.context_limit()} tokens"
+        status += f", Cache: {self.cache.stats()}"
+        if tab.conversation_tree.spill is not None:
+            status += f", Spilled: {tab.conversation_tree.spill.stats()}"
+        if self.rolling_stats is not None:
+            summary = self.rolling_stats.summary()
+            if summary:
+                status += f" | Metrics: {summary}"
+        requests = ', '.join(str(request) for request in tab.active_requests.values())
+        if requests:
+            status += f" | Requests: {requests}"
+        background = sum(len(other.active_requests) for other in self.tabs if other is not tab)
+        if background:
+            status += f" | {background} in other tabs"
+        self.status_bar.config(text=status)
+        # Tabs show their number of requests in flight
+        for other in self.tabs:
+            self.notebook.tab(other.frame, text=other.label())
+
+    def run_command(self, cmd: str):
+        parts = cmd.strip().split(' ')
+        command = parts[0]
+        args = parts[1:]
+        tab = self.tab
+        if command == 'help':
+            self.help_menu()
+        elif command == 'new':
+            self.select_tab(self.new_tab())
+        elif command == 'close':
+            self.close_tab(tab)
+        elif command == 'priority':
+            if not args or args[0] not in TAB_PRIORITIES:
+                messagebox.showerror("Error", f"Tab priority must be one of: {', '.join(TAB_PRIORITIES)}")
+                return
+            self.set_tab_priority(args[0])
+        elif command == 'save':
+            tab.save_conversation(args)
+        elif command == 'reset':
+            tab.reset()
+        elif command == 'load':
+            tab.load_menu()
+        elif command == 'archive':
+            tab.save_to_archive(args)
+        elif command == 'open':
+            self.archive_menu()
+        elif command == 'import':
+            self.import_completions(args[0] if args else 'completions')
+        elif command == 'search':
+            self.search_menu(' '.join(args))
+        elif command == 'change_model':
+            self.model_menu()
+        elif command == 'include':
+            tab.include(args[0] if args else None)
+        elif command == 'excerpts':
+            tab.include(args[0] if args else None, excerpts=True)
+        elif command == 'regen':
+            if args and not args[0].isdigit():
+                messagebox.showerror("Error", f"Bad number of responses: {args[0]}")
+                return
+            tab.regen_message(int(args[0]) if args else 1)
+        elif command == 'compare':
+            unknown = [model for model in args if model not in MODEL_CONTEXT_LIMITS]
+            if unknown:
+                messagebox.showerror("Error", f"Unknown model: {', '.join(unknown)}")
+                return
+            if args:
+                tab.compare_models(args)
+            else:
+                self.compare_menu()
+        elif command == 'summarize':
+            if args and not args[0].isdigit():
+                messagebox.showerror("Error", f"Bad number of messages: {args[0]}")
+                return
+            if args:
+                self.summarizer.window = int(args[0])
+                self.summarize_turns.set(True)
+            else:
+                self.summarize_turns.set(not self.summarize_turns.get())
+            messagebox.showinfo("Summarize", f"Summarizing older turns {'on, the last ' + str(self.summarizer.window) + ' messages are sent as they are' if self.summarize_turns.get() else 'off'}")
+        elif command == 'cancel':
+            tab.cancel_requests()
+        elif command == 'trim':
+            if not args or args[0] not in TRIM_POLICIES:
+                messagebox.showerror("Error", f"Context overflow policy must be one of: {', '.join(TRIM_POLICIES)}")
+                return
+            self.trim_policy.set(args[0])
+        elif command == 'stream':
+            self.stream_responses.set(not self.stream_responses.get())
+            messagebox.showinfo("Stream", f"Streaming responses {'on' if self.stream_responses.get() else 'off'}")
+        elif command == 'cache':
+            if args and args[0] == 'clear':
+                self.cache.clear()
+                messagebox.showinfo("Cache", "Response cache cleared")
+            else:
+                self.use_cache.set(not self.use_cache.get())
+                messagebox.showinfo("Cache", f"Response cache {'on' if self.use_cache.get() else 'off'}")
+        elif command == 'quit':
+            self.on_quit()
+        else:
+            messagebox.showerror("Error", f"Unknown command: {cmd}")
+
+    def help_menu(self):
+        help_text = '''
+HELP MENU:
+new: open a new conversation tab (Ctrl+T)
+close: close the current tab, asking to save it first (Ctrl+W)
+priority [high|normal|low]: how soon this tab's requests are sent while it is in the background
+save [file_name]: saves the conversation tree to "completions/[file_name]_[today].json" and resets the tab
+load: go to load menu (tab will be reset)
+archive [name]: saves the conversation tree to the archive database and resets the tab
+open: open a conversation from the archive database (tab will be reset)
+import [folder]: import the saved conversations in folder (default "completions") into the archive database
+search [terms]: search every message in the archive, "quoted phrases" match exactly
+reset: reset conversation (tab will be reset)
+change_model: change the model of the current tab
+include [file_name]: include file data in the current context
+excerpts [file_name]: include a large file, only the parts relevant to each message are sent
+regen [n]: rerun last message again, with n the number of responses to generate in parallel as separate branches
+compare [models]: send the last message to several models at once, every response becomes a branch
+summarize [n]: toggle sending older turns of long branches as a summary, with n the number of recent messages kept as they are
+cancel: cancel the responses that are still being generated in the current tab
+trim [error|drop_oldest]: what to do when the prompt is larger than the model's context
+stream: toggle streaming of responses as they are generated
+cache [clear]: toggle the response cache, or clear it
+'''
+        messagebox.showinfo("Help", help_text)
+
+    def get_archive(self):
+        if self.archive is None:
+            self.archive = ConversationArchive()
+        return self.archive
+
+    def archive_menu(self):
+        tab = self.tab
+        tab.ask_save()
+        conversations = self.get_archive().list()
+        if not conversations:
+            messagebox.showinfo("Archive", "The archive is empty, save a conversation to it or import the completions folder first.")
+            return
+        archive_window = tk.Toplevel(self.root)
+        archive_window.title("Open from Archive")
+        listbox = tk.Listbox(archive_window, width=80, height=20)
+        listbox.pack(fill='both', expand=True)
+        for _, name, model, total_tokens, saved in conversations:
+            listbox.insert(tk.END, f"{name}    {model}    {saved}")
+        def open_selected():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            archive_window.destroy()
+            tab.open_from_archive(conversations[selection[0]][0])
+        listbox.bind('<Double-Button-1>', lambda e: open_selected())
+        tk.Button(archive_window, text="Open", command=open_selected).pack(fill='x')
+        tk.Button(archive_window, text="Cancel", command=archive_window.destroy).pack(fill='x')
+
+    def search_menu(self, query: str = ''):
+        # Saved files that are not indexed yet are imported first, files that already are are skipped
+        if os.path.exists('completions'):
+            self.get_archive().import_directory('completions')
+        search_window = tk.Toplevel(self.root)
+        search_window.title("Search")
+        query_entry = tk.Entry(search_window, width=80)
+        query_entry.pack(fill='x')
+        query_entry.insert(0, query)
+        listbox = tk.Listbox(search_window, width=120, height=25)
+        listbox.pack(fill='both', expand=True)
+        hits = []
+        def search():
+            hits[:] = self.get_archive().search(query_entry.get())
+            listbox.delete(0, tk.END)
+            for _, name, _, _, role, snippet in hits:
+                listbox.insert(tk.END, f"{name}    {role}: {' '.join(snippet.split())}")
+            if not hits:
+                listbox.insert(tk.END, "No matches")
+        def open_selected():
+            selection = listbox.curselection()
+            if not selection or selection[0] >= len(hits):
+                return
+            conversation_id, _, source, node_id, _, _ = hits[selection[0]]
+            path_ids = self.get_archive().get_path_ids(conversation_id, node_id)
+            search_window.destroy()
+            # Results open in a tab of their own unless the current one is still empty
+            tab = self.tab
+            if tab.conversation_tree.root.children:
+                tab = self.new_tab()
+                self.select_tab(tab)
+            # Saved files are opened from the file, everything else from the archive
+            if source and os.path.exists(source):
+                tab.load_file(source, path_ids)
+            else:
+                tab.open_from_archive(conversation_id, path_ids)
+        query_entry.bind('<Return>', lambda e: search())
+        listbox.bind('<Double-Button-1>', lambda e: open_selected())
+        tk.Button(search_window, text="Open", command=open_selected).pack(fill='x')
+        tk.Button(search_window, text="Cancel", command=search_window.destroy).pack(fill='x')
+        query_entry.focus_set()
+        if query:
+            search()
+
+    def import_completions(self, directory: str):
+        if not os.path.exists(directory):
+            messagebox.showerror("Error", f"Could not find folder {directory}")
+            return
+        imported = self.get_archive().import_directory(directory)
+        messagebox.showinfo("Import", f"Imported {len(imported)} conversations into the archive")
+
+    def model_menu(self):
+        tab = self.tab
+        models = list(MODEL_CONTEXT_LIMITS)
+        def set_model(model):
+            tab.client.change_model(model)
+            tab.journal.record('model_changed', model=model)
+            messagebox.showinfo("Model Changed", f"Model changed to {model}")
+            self.update_status()
+            model_window.destroy()
+        model_window = tk.Toplevel(self.root)
+        model_window.title("Select Model")
+        tk.Label(model_window, text="Select a model:").pack()
+        for model in models:
+            tk.Button(model_window, text=model, command=lambda m=model: set_model(m)).pack(fill='x')
+        tk.Button(model_window, text="Cancel", command=model_window.destroy).pack(fill='x')
+
+    def regen_menu(self):
+        count = simpledialog.askinteger("Regenerate", "Number of responses:", initialvalue=3, minvalue=1, maxvalue=10)
+        if count:
+            self.tab.regen_message(count)
+
+    def compare_menu(self):
+        tab = self.tab
+        compare_window = tk.Toplevel(self.root)
+        compare_window.title("Compare Models")
+        tk.Label(compare_window, text="Send the last message to:").pack()
+        selected = {}
+        for model in MODEL_CONTEXT_LIMITS:
+            selected[model] = tk.BooleanVar(value=True)
+            tk.Checkbutton(compare_window, text=model, variable=selected[model], anchor='w').pack(fill='x')
+        def compare():
+            models = [model for model, var in selected.items() if var.get()]
+            compare_window.destroy()
+            if models:
+                tab.compare_models(models)
+        tk.Button(compare_window, text="Compare", command=compare).pack(fill='x')
+        tk.Button(compare_window, text="Cancel", command=compare_window.destroy).pack(fill='x')
+
     def on_quit(self):
+        self.scheduler.cancel_all()
+        # Leave compact snapshots behind, the tabs are restored from them on the next start
+        for tab in self.tabs:
+            tab.journal.compact()
+            tab.journal.close()
+        self.save_tabs()
         self.root.quit()
         self.root.destroy()
 
@@ -0,0 +1,205 @@
+import json
+import time
+import threading
+from collections import deque, defaultdict
+from contextlib import nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Per-request metrics and timings of the hot paths, handed to whichever sinks are added. With no sinks every hook is
+# a single attribute check, so the instrumentation can stay in place.
+
+_null_timer = nullcontext()
+
+class Timer:
+    def __init__(self, metrics, name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.timing(self.name, time.perf_counter() - self.start)
+
+class Metrics:
+    def __init__(self):
+        self.sinks = []
+        self.enabled = False
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.enabled = True
+        return sink
+
+    def remove_sink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+        self.enabled = bool(self.sinks)
+
+    def timed(self, name: str):
+        # with metrics.timed('context'): ...
+        if not self.enabled:
+            return _null_timer
+        return Timer(self, name)
+
+    def timing(self, name: str, seconds: float):
+        for sink in self.sinks:
+            sink.on_timing(name, seconds)
+
+    def record_request(self, request):
+        # Called by the scheduler when a request finished, on the worker thread
+        if not self.enabled:
+            return
+        record = request_record(request)
+        for sink in self.sinks:
+            sink.on_request(record)
+
+def request_record(request) -> dict:
+    started = request.started or request.finished
+    usage = request.usage
+    stats = request.stats
+    first_token = stats.get('first_token')
+    completion_tokens = usage.get('completion_tokens', 0)
+    # Only a streamed response has its tokens arriving after the first one, otherwise they all come with the last
+    streamed = stats.get('streamed', False)
+    generating = request.finished - (first_token if streamed and first_token else started)
+    def ms(seconds):
+        return round(seconds * 1000, 1)
+    return {
+        'time': request.finished,
+        'id': request.id,
+        'label': request.label,
+        'state': request.state,
+        'queue_ms': ms(started - request.created),
+        'first_token_ms': ms(first_token - started) if first_token else None,
+        'latency_ms': ms(request.finished - started),
+        'prompt_tokens': usage.get('prompt_tokens', 0),
+        'completion_tokens': completion_tokens,
+        'tokens_per_second': round(completion_tokens / generating, 1) if generating > 0 and completion_tokens else None,
+        'streamed': streamed,
+        'retries': stats.get('retries', 0),
+        'cache_hit': stats.get('cache_hit', False),
+    }
+
+class RollingStats:
+    # The last window requests and timings, summarized for the status bar
+    def __init__(self, window: int = 50):
+        self.lock = threading.Lock()
+        self.requests = deque(maxlen=window)
+        self.timings = defaultdict(lambda: deque(maxlen=window))
+
+    def on_request(self, record: dict):
+        with self.lock:
+            self.requests.append(record)
+
+    def on_timing(self, name: str, seconds: float):
+        with self.lock:
+            self.timings[name].append(seconds)
+
+    def summary(self) -> str:
+        with self.lock:
+            done = [r for r in self.requests if r['state'] == 'done']
+            timings = { name: sorted(values) for name, values in self.timings.items() if values }
+        def median(values):
+            return values[len(values) // 2] if values else None
+        parts = []
+        if done:
+            parts.append(f"latency {median(sorted(r['latency_ms'] for r in done)) / 1000:.2f}s")
+            first_tokens = sorted(r['first_token_ms'] for r in done if r['first_token_ms'] is not None and not r['cache_hit'])
+            if first_tokens:
+                parts.append(f"first token {median(first_tokens) / 1000:.2f}s")
+            rates = sorted(r['tokens_per_second'] for r in done if r['tokens_per_second'] and not r['cache_hit'])
+            if rates:
+                parts.append(f"{median(rates):.0f} tokens/s")
+            parts.append(f"queue {median(sorted(r['queue_ms'] for r in done)):.0f}ms")
+            parts.append(f"{sum(r['retries'] for r in done)} retries")
+            parts.append(f"{sum(1 for r in done if r['cache_hit'])}/{len(done)} cached")
+        for name, values in sorted(timings.items()):
+            parts.append(f"{name} {median(values) * 1000:.2f}ms")
+        return ', '.join(parts)
+
+class JsonlSink:
+    # Every request and, if timings is set, every timing as one JSON line
+    def __init__(self, file_name: str = 'metrics.jsonl', timings: bool = False):
+        self.lock = threading.Lock()
+        self.file = open(file_name, 'a', encoding='utf-8')
+        self.timings = timings
+
+    def write(self, data: dict):
+        with self.lock:
+            self.file.write(json.dumps(data) + '\n')
+            self.file.flush()
+
+    def on_request(self, record: dict):
+        self.write(dict(record, type='request'))
+
+    def on_timing(self, name: str, seconds: float):
+        if self.timings:
+            self.write({ 'type': 'timing', 'time': time.time(), 'name': name, 'ms': round(seconds * 1000, 3) })
+
+    def close(self):
+        self.file.close()
+
+class PrometheusSink:
+    # Totals in the Prometheus text format, served on http://127.0.0.1:port/metrics
+    def __init__(self, port: int = 9464):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # By state
+        self.sums = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.totals = defaultdict(int)
+        self.timing_sums = defaultdict(float)
+        self.timing_counts = defaultdict(int)
+        sink = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode('utf-8')
+                self.send_response(200 if self.path.startswith('/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def on_request(self, record: dict):
+        with self.lock:
+            self.requests[record['state']] += 1
+            for name in ('queue', 'first_token', 'latency'):
+                if record[f'{name}_ms'] is not None:
+                    self.sums[name] += record[f'{name}_ms'] / 1000
+                    self.counts[name] += 1
+            self.totals['prompt_tokens'] += record['prompt_tokens']
+            self.totals['completion_tokens'] += record['completion_tokens']
+            self.totals['retries'] += record['retries']
+            self.totals['cache_hits'] += int(record['cache_hit'])
+
+    def on_timing(self, name: str, seconds: float):
+        with self.lock:
+            self.timing_sums[name] += seconds
+            self.timing_counts[name] += 1
+
+    def render(self) -> str:
+        with self.lock:
+            lines = ['# TYPE simple_llm_requests_total counter']
+            lines += [f'simple_llm_requests_total{{state="{state}"}} {count}' for state, count in sorted(self.requests.items())]
+            for name in ('queue', 'first_token', 'latency'):
+                lines.append(f'# TYPE simple_llm_{name}_seconds summary')
+                lines.append(f'simple_llm_{name}_seconds_sum {self.sums[name]:.6f}')
+                lines.append(f'simple_llm_{name}_seconds_count {self.counts[name]}')
+            for name in ('prompt_tokens', 'completion_tokens', 'retries', 'cache_hits'):
+                lines.append(f'# TYPE simple_llm_{name}_total counter')
+                lines.append(f'simple_llm_{name}_total {self.totals[name]}')
+            lines.append('# TYPE simple_llm_timing_seconds summary')
+            for name in sorted(self.timing_sums):
+                lines.append(f'simple_llm_timing_seconds_sum{{name="{name}"}} {self.timing_sums[name]:.6f}')
+                lines.append(f'simple_llm_timing_seconds_count{{name="{name}"}} {self.timing_counts[name]}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.server.shutdown()
+
+metrics = Metrics()  # Shared by the whole process
@@ -0,0 +1,156 @@
+import re
+import time
+import random
+import threading
+
+# Shared by every request to a model, no matter which thread or chat it comes from, so that all of them together stay
+# within the provider's requests and tokens per minute. The limits start at DEFAULT_* and are learned from the
+# x-ratelimit-* headers of every response.
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 30000
+MAX_RETRIES = 6
+BASE_DELAY = 1  # Seconds before the first retry, doubled on every further retry
+MAX_DELAY = 60
+WAIT_SLICE = 0.1  # Longest a waiting request sleeps before it checks again whether it was cancelled
+
+RETRYABLE_STATUS = {408, 409, 429}
+RETRYABLE_ERRORS = {'APIConnectionError', 'APITimeoutError'}
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+def parse_duration(text: str) -> float:
+    # Reset times come as e.g. "1s", "6m0s" or "20ms"
+    seconds = 0.0
+    for value, unit in DURATION_PATTERN.findall(text or ''):
+        seconds += float(value) * { 'h': 3600, 'm': 60, 's': 1, 'ms': 0.001 }[unit]
+    return seconds
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        # Requests larger than the whole bucket only wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.capacity
+
+    def set_limit(self, per_minute: int):
+        if per_minute > 0:
+            self.capacity = per_minute
+            self.level = min(self.level, per_minute)
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+                 max_retries: int = MAX_RETRIES):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.blocked_until = 0  # Every caller waits until then after the provider asked to back off
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # Notified when headers or a refund leave more room
+        self.retries = 0
+        self.throttled = 0
+
+    def acquire(self, tokens: int, cancel: threading.Event = None) -> bool:
+        # Blocks until the request fits in both buckets, returns False if it was cancelled while waiting. The wait is
+        # computed again whenever the limits change, a delay from the conservative defaults is not slept out.
+        throttled = False
+        with self.changed:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return False
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                delay = max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= tokens
+                    return True
+                if not throttled:
+                    throttled = True
+                    self.throttled += 1
+                self.changed.wait(min(delay, WAIT_SLICE) if cancel is not None else delay)
+
+    def refund(self, reserved: int, used: int):
+        # A request reserves its prompt and max_tokens, what the response did not use is given back
+        if used >= reserved:
+            return
+        with self.changed:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + reserved - used)
+            self.changed.notify_all()
+
+    def update_from_headers(self, headers):
+        if headers is None:
+            return
+        with self.changed:
+            now = time.monotonic()
+            for bucket, name in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+                limit = headers.get(f'x-ratelimit-limit-{name}')
+                if limit and limit.isdigit():
+                    bucket.set_limit(int(limit))
+                # The provider's count replaces the local one, in both directions
+                remaining = headers.get(f'x-ratelimit-remaining-{name}')
+                if remaining and remaining.isdigit():
+                    bucket.level = min(bucket.capacity, int(remaining))
+                    bucket.updated = now
+            self.changed.notify_all()
+
+    def is_retryable(self, e: Exception) -> bool:
+        if type(e).__name__ in RETRYABLE_ERRORS:
+            return True
+        status = getattr(e, 'status_code', None)
+        if status is None:
+            return False
+        if getattr(e, 'code', None) == 'insufficient_quota':
+            return False  # Also a 429, but waiting does not help
+        return status in RETRYABLE_STATUS or status >= 500
+
+    def on_error(self, e: Exception, attempt: int) -> float:
+        # Returns how long to wait before the next attempt: exponential backoff with full jitter, or longer if the
+        # provider said when to come back, in which case every other caller waits as well
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        response = getattr(e, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if headers is not None and getattr(e, 'status_code', None) == 429:
+            retry_after = self.get_retry_after(headers)
+            if retry_after > 0:
+                delay = max(delay, retry_after)
+                with self.lock:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        with self.lock:
+            self.retries += 1
+        return delay
+
+    def get_retry_after(self, headers) -> float:
+        if headers.get('retry-after-ms'):
+            try:
+                return float(headers['retry-after-ms']) / 1000
+            except ValueError:
+                pass
+        if headers.get('retry-after'):
+            try:
+                return float(headers['retry-after'])
+            except ValueError:
+                pass
+        return max(parse_duration(headers.get('x-ratelimit-reset-requests')), parse_duration(headers.get('x-ratelimit-reset-tokens')))
+
+    def status(self) -> str:
+        return f"{self.requests.capacity} requests/min, {self.tokens.capacity} tokens/min, {self.retries} retries"
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(model: str) -> RateLimiter:
+    # Limits are per model, every chat in the process shares the same limiter for a model
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter()
+        return _limiters[model]
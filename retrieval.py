@@ -0,0 +1,90 @@
+import re
+import math
+from collections import Counter, defaultdict
+from typing import List
+
+# Lexical retrieval over the chunks of a document, so that only the parts relevant to a message are sent along
+CHUNK_CHARS = 1500
+TOP_K = 4
+K1 = 1.5
+B = 0.75
+WORD_PATTERN = re.compile(r'\w+')
+
+def tokenize(text: str) -> List[str]:
+    return WORD_PATTERN.findall(text.lower())
+
+def iter_chunks(f, chunk_chars: int = CHUNK_CHARS):
+    # Reads the file in blocks and yields chunks of about chunk_chars, cut at a paragraph, line or word break if there
+    # is one in the second half of the chunk, so the whole document is never in memory at once
+    buffer = ''
+    while True:
+        block = f.read(chunk_chars * 4)
+        buffer += block
+        while len(buffer) >= chunk_chars or (not block and buffer):
+            if len(buffer) <= chunk_chars:
+                cut = len(buffer)
+            else:
+                cut = -1
+                for separator in ('\n\n', '\n', ' '):
+                    cut = buffer.rfind(separator, chunk_chars // 2, chunk_chars)
+                    if cut != -1:
+                        cut += len(separator)
+                        break
+                if cut == -1:
+                    cut = chunk_chars
+            chunk = buffer[:cut]
+            buffer = buffer[cut:]
+            if chunk.strip():
+                yield chunk
+        if not block:
+            return
+
+class ChunkIndex:
+    # BM25 over the chunks of one document
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.lengths: List[int] = []
+        self.postings = defaultdict(list)  # Map terms to (chunk, term frequency)
+        self.total_length = 0
+
+    @classmethod
+    def from_file(cls, file_name: str, chunk_chars: int = CHUNK_CHARS):
+        index = cls()
+        with open(file_name, 'r', encoding='utf-8') as f:
+            for chunk in iter_chunks(f, chunk_chars):
+                index.add(chunk)
+        return index
+
+    def add(self, chunk: str):
+        terms = Counter(tokenize(chunk))
+        position = len(self.chunks)
+        self.chunks.append(chunk)
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self.total_length += length
+        for term, count in terms.items():
+            self.postings[term].append((position, count))
+
+    def search(self, query: str, k: int = TOP_K) -> List[int]:
+        # Positions of the k best matching chunks, best first
+        if not self.chunks:
+            return []
+        n = len(self.chunks)
+        average_length = self.total_length / n or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, count in postings:
+                norm = K1 * (1 - B + B * self.lengths[position] / average_length)
+                scores[position] += idf * count * (K1 + 1) / (count + norm)
+        return sorted(scores, key=lambda position: -scores[position])[:k]
+
+    def excerpts(self, query: str = None, k: int = TOP_K) -> List[str]:
+        # The k most relevant chunks in document order, the first k chunks if nothing matches or there is no query
+        positions = self.search(query, k) if query else []
+        if not positions:
+            positions = range(min(k, len(self.chunks)))
+        return [self.chunks[position] for position in sorted(positions)]
@@ -0,0 +1,147 @@
+import time
+import queue
+import threading
+import itertools
+from typing import Dict, List
+
+from gpt import RequestCancelled
+from metrics import metrics
+
+class Request:
+    def __init__(self, id: int, label: str, work, on_token=None, on_done=None, on_error=None, on_cancel=None, priority: int = 0):
+        self.id = id
+        self.label = label
+        self.work = work  # Called on a worker thread with this request, returns the result
+        self.on_token = on_token
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.priority = priority
+        self.state = 'queued'  # 'queued', 'running', 'done', 'cancelled' or 'error'
+        self.cancel_event = threading.Event()
+        self.created = time.time()
+        self.started = None  # When a worker picked it up
+        self.finished = None
+        self.usage = {}  # Token usage, filled in by the work
+        self.stats = {}  # First token time, retries and cache hits, filled in by the work
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def __str__(self):
+        state = 'cancelling' if self.cancelled and self.state == 'running' else self.state
+        return f"#{self.id} {self.label}: {state}"
+
+class RequestScheduler:
+    requests: Dict[int, Request]
+
+    def __init__(self, max_workers: int = 8):
+        self.pending = queue.PriorityQueue()  # Requests waiting for a worker
+        self.callbacks = queue.Queue()  # Results waiting to be handed back to the Tk thread
+        self.requests = {}  # Active (queued or running) requests by id
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.changed = False
+        self.workers = []
+        for _ in range(max_workers):
+            worker = threading.Thread(target=self.worker_loop, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, work, label: str = '', on_token=None, on_done=None, on_error=None, on_cancel=None, priority: int = 0) -> Request:
+        request = Request(next(self.ids), label, work, on_token, on_done, on_error, on_cancel, priority)
+        with self.lock:
+            self.requests[request.id] = request
+            self.changed = True
+        self.pending.put((priority, request.id, request))
+        return request
+
+    def set_priority(self, request: Request, priority: int):
+        # A queued request is queued again with the new priority, workers skip the entry it leaves behind
+        with self.lock:
+            if request.state != 'queued' or request.priority == priority:
+                return
+            request.priority = priority
+        self.pending.put((priority, request.id, request))
+
+    def cancel(self, request: Request):
+        # Queued requests are dropped when a worker picks them up, running ones stop at the next chunk
+        request.cancel_event.set()
+        with self.lock:
+            self.changed = True
+
+    def cancel_all(self):
+        for request in self.active():
+            self.cancel(request)
+
+    def active(self) -> List[Request]:
+        with self.lock:
+            return list(self.requests.values())
+
+    def post(self, request: Request, callback, *args):
+        if callback is not None:
+            self.callbacks.put((request, callback, args))
+
+    def emit_token(self, request: Request, token: str):
+        self.post(request, request.on_token, token)
+
+    def worker_loop(self):
+        while True:
+            priority, _, request = self.pending.get()
+            with self.lock:
+                # Entries left behind by set_priority are skipped, the request is claimed from the current one
+                stale = request.state != 'queued' or priority != request.priority
+                if not stale:
+                    request.state = 'running'
+                    self.changed = True
+            if stale:
+                continue
+            if request.cancelled:
+                self.finish(request, 'cancelled', request.on_cancel)
+                continue
+            request.started = time.time()
+            try:
+                result = request.work(request)
+            except Exception as e:
+                if request.cancelled or isinstance(e, RequestCancelled):
+                    self.finish(request, 'cancelled', request.on_cancel)
+                else:
+                    self.finish(request, 'error', request.on_error, e)
+            else:
+                if request.cancelled:
+                    self.finish(request, 'cancelled', request.on_cancel)
+                else:
+                    self.finish(request, 'done', request.on_done, result)
+
+    def finish(self, request: Request, state: str, callback, *args):
+        with self.lock:
+            request.state = state
+            request.finished = time.time()
+            self.requests.pop(request.id, None)
+            self.changed = True
+        metrics.record_request(request)
+        self.post(request, callback, *args)
+
+    def process_callbacks(self) -> bool:
+        # Must be called from the Tk thread, returns True if the state of any request changed
+        while True:
+            try:
+                request, callback, args = self.callbacks.get_nowait()
+            except queue.Empty:
+                break
+            if request.cancelled and callback is not request.on_cancel:
+                if callback is request.on_token:
+                    continue
+                # Cancelled after it finished but before the result was handed over, it still has to be cleaned up
+                callback, args = request.on_cancel, ()
+                if callback is None:
+                    continue
+            callback(*args)
+        with self.lock:
+            changed = self.changed
+            self.changed = False
+        return changed
+
+    def status(self) -> str:
+        return ', '.join(str(request) for request in self.active())
@@ -0,0 +1,66 @@
+import tempfile
+import threading
+
+# Memory bound for huge trees: once the text held in memory passes max_bytes, the messages of branches off the
+# selected path are written to a temporary file and only their structure stays in memory. Their text is read back
+# from the file when something asks for it, and kept in memory again when their branch is selected.
+CHECK_FRACTION = 8  # The tree is checked again after max_bytes / CHECK_FRACTION of new text
+
+class SpillStore:
+    def __init__(self, max_bytes: int, directory: str = None):
+        self.max_bytes = max_bytes
+        self.check_bytes = max(1, max_bytes // CHECK_FRACTION)
+        self.file = tempfile.TemporaryFile(dir=directory)  # Deleted when closed
+        self.lock = threading.Lock()  # Spilled messages can be read from the worker threads
+        self.offsets = {}  # Map node keys to the (offset, length) of their text in the file
+        self.end = 0
+        self.spilled = 0  # Nodes whose text is only in the file
+        self.spilled_bytes = 0
+        self.reads = 0
+
+    def spill(self, node):
+        # Text that was spilled before is still in the file, it is not written again
+        message = node._message
+        with self.lock:
+            if node.key not in self.offsets:
+                data = message.encode('utf-8')
+                self.file.seek(self.end)
+                self.file.write(data)
+                self.offsets[node.key] = (self.end, len(data))
+                self.end += len(data)
+            self.spilled += 1
+            self.spilled_bytes += self.offsets[node.key][1]
+        node._message = None
+        node.spill = self
+
+    def read(self, key: int) -> str:
+        with self.lock:
+            offset, length = self.offsets[key]
+            self.file.seek(offset)
+            data = self.file.read(length)
+            self.reads += 1
+        return data.decode('utf-8')
+
+    def load(self, node) -> int:
+        # Keep the text in memory again, returns its size
+        message = self.read(node.key)
+        with self.lock:
+            self.spilled -= 1
+            self.spilled_bytes -= self.offsets[node.key][1]
+        node._message = message
+        return len(message)
+
+    def forget(self, node):
+        # The node's text changed or the node is gone, its copy in the file is stale
+        with self.lock:
+            if node.key in self.offsets:
+                _, length = self.offsets.pop(node.key)
+                if node._message is None:
+                    self.spilled -= 1
+                    self.spilled_bytes -= length
+
+    def stats(self) -> str:
+        return f"{self.spilled} messages ({self.spilled_bytes / 1024 / 1024:.1f} MB) on disk, {self.reads} reads"
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,101 @@
+import threading
+from typing import List
+
+from blobs import BlobStore, has_references
+from gpt import RequestCancelled
+from tokens import REPLY_PRIMING
+
+# Long branches are sent as a summary of their older turns followed by the latest ones. Summaries are made every
+# stride messages and each builds on the one before, so the path is summarized bit by bit as it grows. They are
+# cached on the tree under the last node they cover, which every branch continuing from that node shares.
+SUMMARY_PROMPT = '''Summarize the conversation below for the assistant that will continue it. Keep names, facts, numbers, \
+decisions, open questions and anything the user asked to be remembered. Write it as compact notes.'''
+SUMMARY_TOKENS = 500  # Longest summary that is asked for
+WINDOW = 10  # Most recent messages that are always sent as they are
+STRIDE = 10  # Messages added to the summary at a time
+WAIT_SLICE = 0.1  # Longest a request waiting for another one's summary goes without checking whether it was cancelled
+
+class Summarizer:
+    def __init__(self, blobs: BlobStore = None, window: int = WINDOW, stride: int = STRIDE):
+        self.blobs = blobs
+        self.window = window
+        self.stride = stride
+        self.lock = threading.Lock()  # Guards pending, never held while a summary is written
+        self.pending = {}  # Keys of the summaries being written, mapped to an event set when the request is done
+
+    def split(self, length: int) -> int:
+        # Number of messages after the system prompt that a path of length messages has summarized, 0 for none
+        older = length - 1 - self.window
+        if older < self.stride:
+            return 0
+        return older // self.stride * self.stride
+
+    def estimate_tokens(self, counts: List[int], messages: List[dict]) -> int:
+        # Prompt size once the older messages are summarized, counts are the token counts of the messages
+        split = self.split(len(messages))
+        pinned = sum(count for count, msg in zip(counts[1:split + 1], messages[1:split + 1]) if has_references(msg["content"]))
+        return counts[0] + SUMMARY_TOKENS + pinned + sum(counts[split + 1:]) + REPLY_PRIMING
+
+    def compact(self, client, tree, path: list, messages: List[dict], cancel: threading.Event = None, model: str = None) -> List[dict]:
+        # Payload for path with its older messages replaced by their summary. Included documents are kept as they are.
+        # Runs on a worker thread, path and messages are taken on the Tk thread.
+        split = self.split(len(messages))
+        if split == 0:
+            return messages
+        summary = self.get_summary(client, tree, path, split, cancel, model)
+        pinned = [msg for msg in messages[1:split + 1] if has_references(msg["content"])]
+        return [messages[0], { "role": "user", "content": f"Summary of our conversation so far:\n{summary}" }] + pinned + messages[split + 1:]
+
+    def get_summary(self, client, tree, path: list, split: int, cancel: threading.Event = None, model: str = None) -> str:
+        # Continue from the latest summary on the path that was already made, by this or another branch
+        summary = None
+        start = 0
+        for boundary in range(split, 0, -self.stride):
+            if path[boundary].key in tree.summaries:
+                summary = tree.summaries[path[boundary].key]
+                start = boundary
+                break
+        for boundary in range(start + self.stride, split + 1, self.stride):
+            summary = self.get_part(client, tree, path, boundary, summary, cancel, model)
+        return summary
+
+    def get_part(self, client, tree, path: list, boundary: int, summary: str, cancel: threading.Event = None, model: str = None) -> str:
+        # Summary up to path[boundary]. Requests for other boundaries, branches and tabs run side by side, one that
+        # needs a summary another request is already writing waits for it instead of asking for it again.
+        key = path[boundary].key
+        while True:
+            with self.lock:
+                if key in tree.summaries:
+                    return tree.summaries[key]
+                done = self.pending.get(key)
+                if done is None:
+                    done = self.pending[key] = threading.Event()
+                    break
+            while not done.wait(WAIT_SLICE):
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+        try:
+            summary = self.summarize(client, summary, path[boundary - self.stride + 1:boundary + 1], cancel, model)
+            with self.lock:
+                tree.summaries[key] = summary
+            return summary
+        finally:
+            # If it failed, the next request that needs it writes it
+            with self.lock:
+                del self.pending[key]
+            done.set()
+
+    def summarize(self, client, summary: str, nodes: list, cancel: threading.Event = None, model: str = None) -> str:
+        # The instruction goes in the user message, o1 models get no system message
+        lines = [SUMMARY_PROMPT, '']
+        if summary:
+            lines.append(f'Summary of the conversation before this part:\n{summary}\n')
+        for node in nodes:
+            # Documents are kept in the payload, the summary only needs to know they are there
+            message = self.blobs.preview(node.message) if self.blobs is not None else node.message
+            lines.append(f'{node.role}: {message}')
+        messages = [
+            { "role": "system", "content": "You summarize conversations." },
+            { "role": "user", "content": '\n'.join(lines) },
+        ]
+        return client.complete(messages, SUMMARY_TOKENS, cancel=cancel, model=model)
@@ -0,0 +1,62 @@
+from typing import List
+
+# Context window of every model that can be picked in the model menu
+MODEL_CONTEXT_LIMITS = {
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'o1-preview': 128000,
+    'o1-mini': 128000
+}
+DEFAULT_CONTEXT_LIMIT = 64000
+
+TOKENS_PER_MESSAGE = 4  # Message framing and the role name
+REPLY_PRIMING = 3  # Every reply is primed with <|start|>assistant<|message|>
+
+TRIM_POLICIES = ['error', 'drop_oldest']
+
+_encoding = None
+
+def get_encoding():
+    # tiktoken is optional, without it the count is an estimate of 4 characters per token
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('o200k_base')  # Used by every model in MODEL_CONTEXT_LIMITS
+        except Exception:
+            _encoding = False
+    return _encoding
+
+def encoding_loaded() -> bool:
+    # Loading the encoding can mean downloading it, the app loads it on a background thread and estimates until then
+    return _encoding is not None
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+def count_message_tokens(text: str) -> int:
+    return count_tokens(text) + TOKENS_PER_MESSAGE
+
+def estimate_message_tokens(text: str) -> int:
+    return estimate_tokens(text) + TOKENS_PER_MESSAGE
+
+def count_prompt_tokens(messages: List[dict]) -> int:
+    return sum(count_message_tokens(msg["content"]) for msg in messages) + REPLY_PRIMING
+
+def get_context_limit(model: str) -> int:
+    return MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+
+def trim_messages(messages: List[dict], counts: List[int], budget: int):
+    # Drop the oldest messages after the system prompt until the prompt fits in the budget, the last message is always kept
+    total = sum(counts) + REPLY_PRIMING
+    start = 1
+    while total > budget and start < len(messages) - 1:
+        total -= counts[start]
+        start += 1
+    return messages[:1] + messages[start:], total
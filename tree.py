@@ -0,0 +1,413 @@
+import itertools
+from uuid import uuid4
+from typing import List
+
+from tokens import REPLY_PRIMING, count_message_tokens, estimate_message_tokens
+from metrics import metrics
+
+node_keys = itertools.count()
+
+class MessageNode:
+    # Nodes use slots and an integer key internally, the uuid is only generated when it is needed as an external id
+    __slots__ = ('key', '_id', '_message', 'role', 'parent', 'children', 'child_index', 'selected_index', 'token_count', 'loader', 'info', 'spill')
+
+    def __init__(self, message: str, role: str, parent=None, id=None, info: dict = None):
+        self.key = next(node_keys)
+        self._id = id
+        self._message = message
+        self.spill = None  # SpillStore holding a copy of the text, see ConversationTree.spill_inactive
+        if role != 'user' and role != 'assistant' and role != 'system':
+            raise Exception(f'Bad role argument for Message node: {role}')
+        self.role = role  # 'user' or 'assistant'
+        self.parent = parent  # Reference to parent MessageNode
+        self.children = []  # List of MessageNode
+        self.child_index = -1  # Position of this node in its parent's children
+        self.selected_index = -1  # Position of the currently selected child node
+        self.token_count = None  # Size of the message in tokens, counted on first use
+        self.loader = None  # Fills in the children of a node that was loaded without them, see load_children
+        self.info = info  # Where a response came from, e.g. { 'model': ..., 'latency': ..., 'usage': ... }
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = str(uuid4())
+        return self._id
+
+    @property
+    def message(self):
+        # The text of a node off the selected path may only be on disk, it is read from there without keeping it
+        if self._message is None and self.spill is not None:
+            return self.spill.read(self.key)
+        return self._message
+
+    @message.setter
+    def message(self, message: str):
+        if self.spill is not None:
+            self.spill.forget(self)
+        self._message = message
+
+    @property
+    def selected_child(self):
+        if self.selected_index < 0:
+            return None
+        return self.children[self.selected_index]
+
+    @selected_child.setter
+    def selected_child(self, node):
+        self.selected_index = -1 if node is None else node.child_index
+
+    def add_child(self, node):
+        node.child_index = len(self.children)
+        self.children.append(node)
+        node.parent = self
+        self.selected_index = node.child_index
+
+    def remove_child(self, node):
+        del self.children[node.child_index]
+        for i in range(node.child_index, len(self.children)):
+            self.children[i].child_index = i
+        if self.selected_index == node.child_index:
+            self.selected_index = -1
+        elif self.selected_index > node.child_index:
+            self.selected_index -= 1
+        node.child_index = -1
+
+    def select_child(self, index: int):
+        if index < 0 or index >= len(self.children):
+            raise Exception(f'Child selection out of range: {index} must be less than {len(self.children)}')
+        self.selected_index = index
+        return self.selected_child
+    
+    def selected_child_index(self):
+        return self.selected_index
+
+class ConversationTree:
+    def __init__(self, sys_prompt: str):
+        self.root = MessageNode(sys_prompt, 'system', None)  # Starting MessageNode
+        self.current_node = self.root  # Current position in the conversation
+        self.contexts = {}  # Map node keys to (shared message list, length) for the path from the root
+        self.prompt_tokens = {}  # Map node keys to the token count of the path from the root
+        self.summaries = {}  # Map node keys to a summary of the path from the root up to that node, see summaries.py
+        self.listener = None  # Called with every change to the tree, e.g. to journal it
+        self.blobs = None  # BlobStore that document references in messages are counted from
+        self.spill = None  # SpillStore that the text of branches off the selected path goes to once over budget
+        self.unchecked_bytes = 0  # Text added since the budget was last checked
+
+    def notify(self, event: str, node: MessageNode):
+        if self.listener is not None:
+            self.listener(event, node)
+
+    def add_message(self, message: str, role: str):
+        new_node = MessageNode(message, role, parent=self.current_node)
+        self.current_node.add_child(new_node)
+        self.current_node = new_node
+        self.notify('node_added', new_node)
+        self.check_budget(len(message))
+        return new_node
+
+    def edit_message(self, edit_node: MessageNode, new_message: str):
+        new_node = MessageNode(new_message, 'user', edit_node.parent)
+        parent_node: MessageNode = edit_node.parent
+        parent_node.add_child(new_node)
+        self.current_node = new_node
+        self.notify('node_added', new_node)
+        self.check_budget(len(new_message))
+        return new_node
+
+    def add_response(self, parent_node: MessageNode, message: str, info: dict = None):
+        # Responses can arrive after the user moved to another branch, only follow them if the parent is still current
+        new_node = MessageNode(message, 'assistant', parent=parent_node, info=info)
+        selected: MessageNode = parent_node.selected_child
+        parent_node.add_child(new_node)
+        if parent_node is self.current_node:
+            self.current_node = new_node
+        elif selected is not None:
+            parent_node.selected_child = selected
+        self.notify('node_added', new_node)
+        self.check_budget(len(message))
+        return new_node
+
+    def select_branch(self, parent_node: MessageNode, index: int):
+        selected_node = parent_node.select_child(index)
+        # Follow the selected children down to the end of the branch
+        self.current_node = load_branch(selected_node)
+        self.load_spilled(selected_node)
+        self.notify('branch_selected', selected_node)
+        return selected_node
+
+    def select_path(self, ids: List[str]):
+        # Select the branches leading to the last of ids, a path of node ids starting at the root
+        node = self.root
+        changed = []
+        for id in ids[1:]:
+            load_children(node)
+            child = next((c for c in node.children if c.id == id), None)
+            if child is None:
+                raise Exception(f'No message {id} below {node.id}')
+            if node.selected_child is not child:
+                node.selected_child = child
+                changed.append(child)
+            node = child
+        self.current_node = load_branch(node)
+        self.load_spilled(self.root)
+        for child in changed:
+            self.notify('branch_selected', child)
+        return node
+
+    def remove_child(self, parent_node: MessageNode, child: MessageNode):
+        if self.spill is not None:
+            stack = [child]
+            while stack:
+                node = stack.pop()
+                self.spill.forget(node)
+                stack.extend(node.children)
+        parent_node.remove_child(child)
+        self.contexts.pop(child.key, None)
+        self.prompt_tokens.pop(child.key, None)
+        self.summaries.pop(child.key, None)
+        if self.current_node is child:
+            self.current_node = parent_node
+        self.notify('node_removed', child)
+
+    def get_path_from_root(self, node: MessageNode = None):
+        if node is None:
+            node = self.current_node
+        with metrics.timed('path'):
+            path = []
+            while node:
+                path.append(node)
+                node = node.parent
+            path.reverse()
+        return path
+
+    def get_context(self, node: MessageNode = None):
+        # Messages from the root to node in API format. Each node's message dict is built once, and a child
+        # appends to its parent's list as long as it is the only continuation of it, so a branch shares a single
+        # list. Starting a new branch copies the prefix, which is O(depth) once per branch.
+        if node is None:
+            node = self.current_node
+        with metrics.timed('context'):
+            missing: List[MessageNode] = []
+            while node is not None and node.key not in self.contexts:
+                missing.append(node)
+                node = node.parent
+            messages, length = self.contexts[node.key] if node is not None else ([], 0)
+            for n in reversed(missing):
+                if len(messages) != length:
+                    messages = messages[:length]
+                messages.append({ "role": n.role, "content": n.message })
+                length += 1
+                self.contexts[n.key] = (messages, length)
+            # The shared list keeps growing on the Tk thread, hand out a copy of the references. That copy is O(depth)
+            # on every call, but it is only pointers, no message dict is built again.
+            return messages[:length]
+
+    def get_node_tokens(self, node: MessageNode):
+        if node.token_count is None:
+            # Documents count with their full text, they are expanded into the payload when it is sent
+            message = self.blobs.expand(node.message) if self.blobs is not None else node.message
+            node.token_count = count_message_tokens(message)
+        return node.token_count
+
+    def get_prompt_tokens(self, node: MessageNode = None):
+        # Size of the prompt for the path up to node, every node is only counted once no matter how many branches share it
+        if node is None:
+            node = self.current_node
+        missing: List[MessageNode] = []
+        while node is not None and node.key not in self.prompt_tokens:
+            missing.append(node)
+            node = node.parent
+        total = self.prompt_tokens[node.key] if node is not None else REPLY_PRIMING
+        for n in reversed(missing):
+            total += self.get_node_tokens(n)
+            self.prompt_tokens[n.key] = total
+        return total
+
+    def estimate_prompt_tokens(self, node: MessageNode = None):
+        # Size of the prompt without the encoding, nothing is cached so later counts are exact
+        total = REPLY_PRIMING
+        for n in self.get_path_from_root(node):
+            total += estimate_message_tokens(self.blobs.expand(n.message) if self.blobs is not None else n.message)
+        return total
+
+    def get_token_counts(self, node: MessageNode = None):
+        return [self.get_node_tokens(n) for n in self.get_path_from_root(node)]
+    
+    def reset_root(self, root_node: MessageNode):
+        self.root = root_node
+        self.contexts = {}
+        self.prompt_tokens = {}
+        self.summaries = {}
+        self.current_node = load_branch(self.root)
+        if self.spill is not None:
+            self.spill_inactive()
+
+    def check_budget(self, added: int):
+        # Walking the tree is only worth it once a good part of the budget was added
+        if self.spill is None:
+            return
+        self.unchecked_bytes += added
+        if self.unchecked_bytes >= self.spill.check_bytes:
+            self.spill_inactive()
+
+    def load_spilled(self, node: MessageNode):
+        # Bring the text of the selected branch from node down back into memory, the branch it replaced goes to
+        # disk at the next check
+        if self.spill is None:
+            return
+        loaded = 0
+        while node is not None:
+            if node._message is None and node.spill is not None:
+                loaded += node.spill.load(node)
+            node = node.selected_child
+        if loaded:
+            self.check_budget(loaded)
+
+    def spill_inactive(self):
+        # Write the text of nodes off the selected path to the spill store, largest first, until the text kept in
+        # memory fits its budget. Branches that were never loaded are not touched.
+        self.unchecked_bytes = 0
+        selected = set()
+        node = self.root
+        while node is not None:
+            selected.add(node.key)
+            node = node.selected_child
+        resident = 0
+        candidates: List[MessageNode] = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node._message is not None:
+                resident += len(node._message)
+                if node.key not in selected and node is not self.current_node:
+                    candidates.append(node)
+            stack.extend(node.children)
+        if resident <= self.spill.max_bytes:
+            return
+        candidates.sort(key=lambda n: len(n._message), reverse=True)
+        for node in candidates:
+            if resident <= self.spill.max_bytes:
+                break
+            resident -= len(node._message)
+            self.spill.spill(node)
+        # Cached contexts of other branches hold on to the text, they are rebuilt from the selected path when needed
+        self.contexts = {}
+
+def load_children(node: MessageNode):
+    # Nodes loaded lazily (e.g. from the archive) get their children the first time they are needed
+    if node.loader is not None:
+        loader = node.loader
+        node.loader = None
+        loader(node)
+
+def load_branch(node: MessageNode):
+    # Load the selected branch below node and return the node it ends at
+    load_children(node)
+    while node.selected_child is not None:
+        node = node.selected_child
+        load_children(node)
+    return node
+
+def serialize_node(node: MessageNode):
+    # Iterative so that deep conversations do not hit the recursion limit, children that were never loaded are loaded first
+    root_data = None
+    stack = [(node, None)]
+    while stack:
+        node, siblings = stack.pop()
+        load_children(node)
+        data = {
+            'id': node.id,
+            'message': node.message,
+            'role': node.role,
+            'children': [],
+            'selected_child_id': node.selected_child.id if node.selected_child else None,
+        }
+        if node.info is not None:
+            data['info'] = node.info
+        if siblings is None:
+            root_data = data
+        else:
+            siblings.append(data)
+        for child in reversed(node.children):
+            stack.append((child, data['children']))
+    return root_data
+
+def deserialize_node(data, parent: MessageNode = None):
+    # Iterative counterpart of serialize_node
+    root = MessageNode(data['message'], data['role'], parent=parent, id=data['id'], info=data.get('info'))
+    stack = [(data, root)]
+    while stack:
+        data, node = stack.pop()
+        # Deserialize children
+        selected = None
+        for child_data in data.get('children', []):
+            child_node = MessageNode(child_data['message'], child_data['role'], id=child_data['id'], info=child_data.get('info'))
+            node.add_child(child_node)
+            if child_data['id'] == data.get('selected_child_id'):
+                selected = child_node
+            stack.append((child_data, child_node))
+        # Restore the selected branch, the last child stays selected for files without one
+        if selected is not None:
+            node.selected_child = selected
+    return root
+
+def flatten_node(node: MessageNode, expand: bool = True):
+    # Flat list of the nodes below node, parents before their children and siblings in order. Unlike the nested
+    # format it has no depth limit when written as JSON or as database rows.
+    rows = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if expand:
+            load_children(node)
+        rows.append({
+            'id': node.id,
+            'parent_id': node.parent.id if node.parent is not None and rows else None,
+            'message': node.message,
+            'role': node.role,
+            'selected_child_id': node.selected_child.id if node.selected_child else None,
+            'loaded': node.loader is None,
+            'info': node.info,
+        })
+        if node.loader is None:
+            stack.extend(reversed(node.children))
+    return rows
+
+def unflatten_nodes(rows: List[dict], loader=None):
+    # Rebuild the nodes written by flatten_node and return the first one
+    nodes = {}
+    root = None
+    for row in rows:
+        node = MessageNode(row['message'], row['role'], id=row['id'], info=row.get('info'))
+        nodes[node.id] = node
+        if root is None:
+            root = node
+        else:
+            nodes[row['parent_id']].add_child(node)
+        if not row.get('loaded', True):
+            node.loader = loader
+    # Restore the selected branches once every child exists
+    for row in rows:
+        if row.get('selected_child_id') in nodes:
+            nodes[row['id']].selected_child = nodes[row['selected_child_id']]
+    return root
+
+SAVE_VERSION = 2  # Saved files with a flat list of nodes, version 1 nested the children in their parents
+
+def conversation_data(root: MessageNode, model: str, total_tokens: int) -> dict:
+    # Contents of a saved conversation file. The nodes are flat so that json writes and reads them without
+    # recursing once per message, which any deep conversation would run into.
+    return {
+        'version': SAVE_VERSION,
+        'model': model,
+        'total_tokens': total_tokens,
+        'nodes': flatten_node(root) if root else [],
+    }
+
+def conversation_root(data: dict):
+    # Root of the conversation in a saved file of either version, None if it has none
+    if data.get('nodes'):
+        return unflatten_nodes(data['nodes'])
+    if data.get('conversation_tree'):
+        return deserialize_node(data['conversation_tree'])
+    return None